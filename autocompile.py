@@ -1,13 +1,15 @@
 # Copyright (C) 2009, Thomas Leonard
 # See http://0install.net/0compile.html
 
-import sys, os, __main__, tempfile, subprocess, signal, shutil
+import sys, os, __main__, tempfile, subprocess, signal, shutil, time, errno, hashlib, socket, json, io
 from xml.dom import minidom
+from xml.parsers.expat import ExpatError
 from optparse import OptionParser
+from contextlib import contextmanager
 from logging import warn
 
 from zeroinstall import SafeException
-from zeroinstall.injector import arch, handler, driver, requirements, model, iface_cache, namespaces, writer, reader, qdom
+from zeroinstall.injector import arch, handler, driver, requirements, model, iface_cache, namespaces, writer, reader, qdom, selections
 from zeroinstall.injector.config import load_config
 from zeroinstall.zerostore import manifest, NotStored
 from zeroinstall.support import tasks, basedir, ro_rmtree
@@ -31,6 +33,9 @@ arch.machine_groups['newbuild'] = arch.machine_groups.get(build_target_machine_t
 arch.machine_ranks['newbuild'] = max(arch.machine_ranks.values()) + 1
 host_arch = '*-newbuild'
 
+# Assumed duration of a build we've never timed, in seconds
+UNKNOWN_BUILD_TIME = 60
+
 class ImplRestriction(model.Restriction):
 	reason = "Not the source we're trying to build"
 
@@ -85,6 +90,232 @@ def add_binary_deps(src_impl, binary_impl):
 			dep = model.process_depends(elem, local_feed_dir = None)
 			binary_impl.requires.append(dep)
 
+def move_tree(src, target):
+	"""Move directory src to target, by renaming it if possible. If it's on a different filesystem,
+	copy it instead (leaving src to be deleted with the rest of the build directory)."""
+	try:
+		os.rename(src, target)
+		return 'moved'
+	except OSError as ex:
+		if ex.errno != errno.EXDEV:
+			raise
+	support.copy_tree(src, target)
+	return 'copied'
+
+def format_duration(seconds):
+	if seconds < 60:
+		return '%d s' % seconds
+	if seconds < 3600:
+		return '%d min %d s' % divmod(seconds, 60)
+	return '%d h %d min' % (seconds // 3600, seconds % 3600 // 60)
+
+def get_requirements(impl_or_command):
+	"""Everything about impl_or_command's dependencies that could affect what the solver selects."""
+	return sorted((dep.interface, getattr(dep, 'importance', None), sorted(str(r) for r in dep.restrictions))
+			for dep in impl_or_command.requires)
+
+class BinaryCache:
+	"""A directory of finished builds, which may be shared between machines (e.g. over NFS).
+	Each entry is a copy of a build's distdir (including its 0install/feed.xml), named by the digest
+	of the source implementation, everything selected to build it and the target architecture."""
+
+	# Change this if the key or the layout changes
+	FORMAT = '1'
+
+	def __init__(self, path):
+		self.path = path
+		if not os.path.isdir(path):
+			os.makedirs(path)
+		self.site_packages = [os.path.join(d, '') for d in basedir.load_data_paths('0install.net', 'site-packages')]
+
+	def identify(self, sel):
+		"""Identify a selected implementation in a way that's the same on every machine."""
+		if sel.digests:
+			return sorted(sel.digests)
+		local_path = sel.local_path
+		if local_path:
+			# (our own builds of the same version are assumed to be equivalent)
+			for site_packages in self.site_packages:
+				if local_path.startswith(site_packages):
+					return ['site-packages', local_path[len(site_packages):]]
+			return ['local', local_path]
+		return [sel.id]		# (e.g. a distribution package)
+
+	def get_key(self, sels):
+		key = hashlib.sha256()
+		def add(*data):
+			key.update(('\0'.join(str(x) for x in data) + '\n').encode('utf-8', 'surrogateescape'))
+		add(self.FORMAT, __main__.version, support.uname[0], build_target_machine_type, sels.interface)
+		for iface_uri, sel in sorted(sels.selections.items()):
+			add(iface_uri, sel.version, sel.attrs.get('arch', ''), *self.identify(sel))
+		return key.hexdigest()
+
+	def lookup(self, sels):
+		"""Returns the path of the cached distdir for this build, if any."""
+		entry = os.path.join(self.path, self.get_key(sels))
+		if os.path.exists(os.path.join(entry, '0install', 'feed.xml')):
+			return entry
+		return None
+
+	def store(self, sels, distdir):
+		"""Add a copy of distdir to the cache. Failure isn't fatal (the build itself worked)."""
+		key = self.get_key(sels)
+		entry = os.path.join(self.path, key)
+		if os.path.exists(entry):
+			return
+		tmp = os.path.join(self.path, '.new-%s-%s-%d' % (key, socket.gethostname(), os.getpid()))
+		try:
+			support.copy_tree(distdir, tmp)
+			os.rename(tmp, entry)
+		except OSError as ex:
+			warn("Failed to add build to binary cache %s: %s", self.path, ex)
+			if os.path.exists(tmp):
+				ro_rmtree(tmp)
+
+class Timeline:
+	"""Records what an autocompile run spends its time on, for 'autocompile --trace', in Chrome's trace
+	event format (for chrome://tracing or Perfetto). Each concurrent build (or prefetch download) gets
+	its own lane while it runs. Lane 0 is used for planning. Does nothing unless enabled."""
+	enabled = False
+
+	def __init__(self):
+		self.events = []
+		self.busy = set()		# lanes in use
+		self.lane_kinds = {0: 'plan'}
+
+	def enable(self, title):
+		self.enabled = True
+		self.start = time.time()
+		self.pid = os.getpid()
+		self._meta(0, 'process_name', title)
+		self._meta(0, 'thread_name', 'plan')
+
+	def _meta(self, lane, name, value):
+		self.events.append({'name': name, 'ph': 'M', 'pid': self.pid, 'tid': lane, 'args': {'name': value}})
+
+	def _us(self, t):
+		return round((t - self.start) * 1e6)
+
+	def get_lane(self, kind):
+		"""Reserve the first free lane of this kind (e.g. 'build'), until release_lane is called."""
+		if not self.enabled:
+			return 0
+		n = 1
+		while True:
+			name = '%s %d' % (kind, n)
+			lanes = [lane for lane, lane_name in self.lane_kinds.items() if lane_name == name]
+			if not lanes:
+				lane = len(self.lane_kinds)
+				self.lane_kinds[lane] = name
+				self._meta(lane, 'thread_name', name)
+				break
+			if lanes[0] not in self.busy:
+				lane = lanes[0]
+				break
+			n += 1
+		self.busy.add(lane)
+		return lane
+
+	def release_lane(self, lane):
+		self.busy.discard(lane)
+
+	@contextmanager
+	def lane(self, kind):
+		lane = self.get_lane(kind)
+		try:
+			yield lane
+		finally:
+			self.release_lane(lane)
+
+	def begin(self, lane, name, **args):
+		if not self.enabled:
+			return None
+		return {'name': name, 'ph': 'X', 'pid': self.pid, 'tid': lane, 'start': time.time(), 'args': args}
+
+	def end(self, span):
+		if span is None:
+			return
+		start = span.pop('start')
+		span['ts'] = self._us(start)
+		span['dur'] = self._us(time.time()) - span['ts']
+		self.events.append(span)
+
+	@contextmanager
+	def span(self, lane, name, **args):
+		span = self.begin(lane, name, **args)
+		try:
+			yield
+		finally:
+			self.end(span)
+
+	def save(self, path):
+		if not self.enabled:
+			return
+		with open(path, 'w') as stream:
+			json.dump({'traceEvents': self.events, 'displayTimeUnit': 'ms'}, stream, indent = 1)
+
+class Journal:
+	"""A record of an autocompile run's progress, so that 'autocompile --resume' can continue from where
+	an interrupted run stopped. Each line is a JSON object, appended (and synced) as things happen:
+	'planned' for each node (with its selections), 'ready' once the plan is complete, 'started' as each
+	build begins, and 'installed' and 'done' as it is moved into site-packages and registered.
+	Does nothing until started."""
+
+	# Change this if the format changes
+	FORMAT = '1'
+
+	active = False
+
+	def __init__(self, iface_uri):
+		self.iface_uri = iface_uri
+		name = hashlib.sha256(iface_uri.encode('utf-8', 'surrogateescape')).hexdigest()[:32] + '.journal'
+		self.path = os.path.join(basedir.save_cache_path('0install.net', '0compile', 'autocompile'), name)
+		self.header = {'event': 'start', 'format': self.FORMAT, 'interface': iface_uri}
+
+	def load(self):
+		"""The entries written by the last run for this interface, or None if there's no usable journal."""
+		try:
+			with open(self.path) as stream:
+				# (ignore a partly-written last line)
+				entries = [json.loads(line) for line in stream if line.endswith('\n')]
+		except (IOError, ValueError) as ex:
+			if os.path.exists(self.path):
+				warn("Ignoring corrupted journal %s: %s", self.path, ex)
+			return None
+		if not entries or entries[0] != self.header:
+			return None
+		return entries[1:]
+
+	def start(self):
+		"""Start a new journal (replacing any old one)."""
+		with open(self.path, 'w') as stream:
+			stream.write(json.dumps(self.header) + '\n')
+		self.active = True
+
+	def add(self, event, **details):
+		if not self.active:
+			return
+		details['event'] = event
+		with open(self.path, 'a') as stream:
+			stream.write(json.dumps(details) + '\n')
+			stream.flush()
+			os.fsync(stream.fileno())
+
+	def planned(self, node):
+		self.add('planned', interface = node.iface_uri, source = node.source_impl_id,
+				deps = [list(dep.key) for dep in node.deps],
+				selections = node.solver.selections.toDOM().toxml())
+
+	def remove(self):
+		if self.active and os.path.exists(self.path):
+			os.unlink(self.path)
+		self.active = False
+
+class ResumedSolve:
+	"""Stands in for the solver of a node planned by an interrupted run (see Journal)."""
+	def __init__(self, sels):
+		self.selections = sels
+
 class AutocompileCache(iface_cache.IfaceCache):
 	def __init__(self):
 		iface_cache.IfaceCache.__init__(self)
@@ -120,14 +351,57 @@ class AutocompileCache(iface_cache.IfaceCache):
 
 		return feed
 
+class BuildNode:
+	"""A source implementation which must be compiled, and the ones that must be compiled before it."""
+	def __init__(self, iface_uri, source_impl_id):
+		self.iface_uri = iface_uri
+		self.source_impl_id = source_impl_id
+		self.deps = []			# BuildNodes
+		self.requirements = None
+		self.solver = None		# from the last solve
+		self.estimate = None		# how long the last builds of this version took (if known)
+		self.priority = 0		# estimated time from starting this build to finishing the whole plan
+		self.lane = 0			# the --trace timeline lane of the build, while it's running
+
+	@property
+	def key(self):
+		return (self.iface_uri, self.source_impl_id)
+
 class AutoCompiler:
 	# If (due to a bug) we get stuck in a loop, we use this to abort with a sensible error.
 	seen = None		# ((iface, source_id) -> new_binary_id)
 
+	nodes = None		# ((iface, source_id) -> BuildNode)
+	built = None		# set of BuildNodes which have been built and registered
+	building = None		# (BuildNode -> Blocker) for builds in progress
+	waiting = 0		# number of builds in progress which are waiting for a nested run_plan
+	failed = None		# (BuildNode -> exception) for builds which failed (with --keep-going)
+	skipped = None		# set of BuildNodes not built because a build they need failed
+
+	solve_count = 0
+	solve_time = 0.0
+
+	prefetching = None	# ((feed, impl_id) -> Blocker) for downloads started by prefetch
+	prefetch_queued = None	# set of (feed, impl_id) waiting for prefetch to start them
+	children = None		# set of Popen objects for background builds
+
 	def __init__(self, config, iface_uri, options):
 		self.iface_uri = iface_uri
 		self.options = options
 		self.config = config
+		self.parallel = options.parallel
+		self.prefetch_limit = options.prefetch
+		self.keep_going = options.keep_going
+		self.durations = support.BuildDurations()
+		self.output = sys.stderr if options.json else sys.stdout	# (--json uses stdout for the plan)
+		self.timeline = Timeline()
+		if options.trace:
+			self.timeline.enable('autocompile %s' % iface_uri)
+		self.journal = Journal(iface_uri)
+		if options.binary_cache:
+			self.binary_cache = BinaryCache(options.binary_cache)
+		else:
+			self.binary_cache = None
 
 	def pretty_print_plan(self, solver, root, indent = '- '):
 		"""Display a tree showing the selected implementations."""
@@ -138,9 +412,9 @@ class AutoCompiler:
 		elif impl.id.startswith('0compile='):
 			real_impl_id = impl.id.split('=', 1)[1]
 			real_impl = impl.feed.implementations[real_impl_id]
-			msg = 'Compile %s (%s)' % (real_impl.get_version(), real_impl.id)
+			msg = 'Compile %s (%s)' % (real_impl.get_version(), real_impl.id) + self.format_estimate(iface.uri, real_impl.get_version())
 		elif impl.arch and impl.arch.endswith('-src'):
-			msg = 'Compile %s (%s)' % (impl.get_version(), impl.id)
+			msg = 'Compile %s (%s)' % (impl.get_version(), impl.id) + self.format_estimate(iface.uri, impl.get_version())
 		else:
 			if impl.arch:
 				msg = 'Use existing binary %s (%s)' % (impl.get_version(), impl.arch)
@@ -153,6 +427,12 @@ class AutoCompiler:
 			for x in solver.requires[iface]:
 				self.pretty_print_plan(solver, x.interface, indent)
 
+	def format_estimate(self, iface_uri, version):
+		estimate = self.durations.estimate(iface_uri, version)
+		if estimate is None:
+			return ''
+		return ' [about %s]' % format_duration(estimate)
+
 	def print_details(self, solver):
 		"""Dump debugging details."""
 		self.note("\nFailed. Details of all components and versions considered:")
@@ -163,29 +443,41 @@ class AutoCompiler:
 		self.note("\nEnd details\n")
 
 	@tasks.aasync
-	def compile_and_register(self, sels, forced_iface_uri = None):
+	def compile_and_register(self, sels, forced_iface_uri = None, lane = 0):
 		"""If forced_iface_uri, register as an implementation of this interface,
-		ignoring the any <feed-for>, etc."""
+		ignoring the any <feed-for>, etc. lane is the build's lane in the --trace timeline."""
 
 		buildenv = BuildEnv(need_config = False)
 		buildenv.config.set('compile', 'interface', sels.interface)
 		buildenv.config.set('compile', 'selections', 'selections.xml')
 		
-		# Download any required packages now, so we can use the GUI to request confirmation, etc
-		download_missing = sels.download_missing(self.config, include_packages = True)
-		if download_missing:
-			yield download_missing
-			tasks.check(download_missing)
+		with self.timeline.span(lane, 'download'):
+			# Wait for any of our downloads which prefetch has already started, and take the
+			# ones it hasn't started yet off its queue (download_missing will get them now)
+			keys = [(sel.feed, sel.id) for sel in sels.selections.values()]
+			self.prefetch_queued.difference_update(keys)
+			while True:
+				pending = [self.prefetching[key] for key in keys
+						if key in self.prefetching and not self.prefetching[key].happened]
+				if not pending:
+					break
+				yield pending
+
+			# Download any required packages now, so we can use the GUI to request confirmation, etc
+			download_missing = sels.download_missing(self.config, include_packages = True)
+			if download_missing:
+				yield download_missing
+				tasks.check(download_missing)
 
 		tmpdir = tempfile.mkdtemp(prefix = '0compile-')
 		try:
-			os.chdir(tmpdir)
-
 			# Write configuration for build...
+			# (other builds may be running at the same time, so don't change directory)
 
-			buildenv.save()
+			with open(os.path.join(tmpdir, support.ENV_FILE), 'w') as stream:
+				buildenv.config.write(stream)
 
-			sel_file = open('selections.xml', 'w')
+			sel_file = open(os.path.join(tmpdir, 'selections.xml'), 'w')
 			try:
 				doc = sels.toDOM()
 				doc.writexml(sel_file)
@@ -195,181 +487,731 @@ class AutoCompiler:
 
 			# Do the build...
 
-			build = self.spawn_build(buildenv.iface_name)
-			if build:
-				yield build
-				tasks.check(build)
+			start = time.time()
+			with self.timeline.span(lane, 'spawn_build', dir = tmpdir):
+				build = self.spawn_build(buildenv.iface_name, tmpdir)
+				if build:
+					yield build
+					tasks.check(build)
 
 			# Register the result...
-			dom = minidom.parse(buildenv.local_iface_file)
+			# (BuildEnv's paths are relative to the current directory)
+			cwd = os.getcwd()
+			os.chdir(tmpdir)
+			try:
+				distdir = buildenv.distdir
+				local_iface_file = buildenv.local_iface_file
+			finally:
+				os.chdir(cwd)
 
-			feed_for_elem, = dom.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'feed-for')
-			claimed_iface = feed_for_elem.getAttribute('interface')
+			if self.binary_cache:
+				with self.timeline.span(lane, 'store in binary cache'):
+					self.binary_cache.store(sels, distdir)
 
-			if forced_iface_uri is not None:
-				if forced_iface_uri != claimed_iface:
-					self.note("WARNING: registering as feed for {forced}, though feed claims to be for {claimed}".format(
-						forced = forced_iface_uri,
-						claimed = claimed_iface))
-			else:
-				forced_iface_uri = claimed_iface		# (the top-level interface being built)
-
-			version = sels.selections[sels.interface].version
-
-			site_package_versions_dir = basedir.save_data_path('0install.net', 'site-packages',
-						*model.escape_interface_uri(forced_iface_uri))
-			leaf =  '%s-%s' % (version, build_target_machine_type)
-			site_package_dir = os.path.join(site_package_versions_dir, leaf)
-			self.note("Storing build in %s" % site_package_dir)
-
-			# 1. Copy new version in under a temporary name. Names starting with '.' are ignored by 0install.
-			tmp_distdir = os.path.join(site_package_versions_dir, '.new-' + leaf)
-			shutil.copytree(buildenv.distdir, tmp_distdir, symlinks = True)
-
-			# 2. Rename the previous build to .old-VERSION (deleting that if it already existed)
-			if os.path.exists(site_package_dir):
-				self.note("(moving previous build out of the way)")
-				previous_build_dir = os.path.join(site_package_versions_dir, '.old-' + leaf)
-				if os.path.exists(previous_build_dir):
-					shutil.rmtree(previous_build_dir)
-				os.rename(site_package_dir, previous_build_dir)
-			else:
-				previous_build_dir = None
+			self.register(sels, distdir, local_iface_file, forced_iface_uri, lane = lane)
 
-			# 3. Rename the new version immediately after renaming away the old one to minimise time when there's
-			# no version.
-			os.rename(tmp_distdir, site_package_dir)
+			self.durations.record(sels.interface, sels.selections[sels.interface].version, time.time() - start)
+		except:
+			self.note("\nBuild failed: leaving build directory %s for inspection...\n" % tmpdir)
+			raise
+		else:
+			ro_rmtree(tmpdir)
+
+	def register(self, sels, distdir, local_iface_file, forced_iface_uri = None, copy = False, lane = 0):
+		"""Move (or copy) distdir into site-packages and register it as a feed.
+		If forced_iface_uri, register as an implementation of this interface,
+		ignoring the any <feed-for>, etc."""
+		dom = minidom.parse(local_iface_file)
 
-			# 4. Delete the old version.
-			if previous_build_dir:
-				self.note("(deleting previous build)")
+		feed_for_elem, = dom.getElementsByTagNameNS(namespaces.XMLNS_IFACE, 'feed-for')
+		claimed_iface = feed_for_elem.getAttribute('interface')
+
+		if forced_iface_uri is not None:
+			if forced_iface_uri != claimed_iface:
+				self.note("WARNING: registering as feed for {forced}, though feed claims to be for {claimed}".format(
+					forced = forced_iface_uri,
+					claimed = claimed_iface))
+		else:
+			forced_iface_uri = claimed_iface		# (the top-level interface being built)
+
+		version = sels.selections[sels.interface].version
+
+		site_package_versions_dir = basedir.save_data_path('0install.net', 'site-packages',
+					*model.escape_interface_uri(forced_iface_uri))
+		leaf =  '%s-%s' % (version, build_target_machine_type)
+		site_package_dir = os.path.join(site_package_versions_dir, leaf)
+		self.note("Storing build in %s" % site_package_dir)
+
+		span = self.timeline.begin(lane, 'copy into site-packages', dir = site_package_dir)
+
+		# 1. Move new version in under a temporary name. Names starting with '.' are ignored by 0install.
+		tmp_distdir = os.path.join(site_package_versions_dir, '.new-' + leaf)
+		if os.path.exists(tmp_distdir):
+			shutil.rmtree(tmp_distdir)		# (left over from an interrupted run)
+		start = time.time()
+		if copy:
+			support.copy_tree(distdir, tmp_distdir)
+			how = 'copied'
+		else:
+			how = move_tree(distdir, tmp_distdir)
+		self.note("(%s build into place in %.1f s)" % (how, time.time() - start))
+
+		# 2. Rename the previous build to .old-VERSION (deleting that if it already existed)
+		if os.path.exists(site_package_dir):
+			self.note("(moving previous build out of the way)")
+			previous_build_dir = os.path.join(site_package_versions_dir, '.old-' + leaf)
+			if os.path.exists(previous_build_dir):
 				shutil.rmtree(previous_build_dir)
+			os.rename(site_package_dir, previous_build_dir)
+		else:
+			previous_build_dir = None
 
-			local_feed = os.path.join(site_package_dir, '0install', 'feed.xml')
-			assert os.path.exists(local_feed), "Feed %s not found!" % local_feed
+		# 3. Rename the new version immediately after renaming away the old one to minimise time when there's
+		# no version.
+		os.rename(tmp_distdir, site_package_dir)
 
-			# Reload - our 0install will detect the new feed automatically
-			iface = self.config.iface_cache.get_interface(forced_iface_uri)
-			reader.update_from_cache(iface, iface_cache = self.config.iface_cache)
-			self.config.iface_cache.get_feed(local_feed, force = True)
+		source_impl_id = sels.selections[sels.interface].id
+		journal_entry = dict(interface = sels.interface, source = source_impl_id,
+				dir = site_package_dir, registered_as = forced_iface_uri)
+		self.journal.add('installed', **journal_entry)
 
-			# Write it out - 0install will add the feed so that older 0install versions can find it
-			writer.save_interface(iface)
+		# 4. Delete the old version.
+		if previous_build_dir:
+			self.note("(deleting previous build)")
+			shutil.rmtree(previous_build_dir)
 
-			seen_key = (forced_iface_uri, sels.selections[sels.interface].id)
-			assert seen_key not in self.seen, seen_key
-			self.seen[seen_key] = site_package_dir
-		except:
-			self.note("\nBuild failed: leaving build directory %s for inspection...\n" % tmpdir)
-			raise
-		else:
-			# Can't delete current directory on Windows, so move to parent first
-			os.chdir(os.path.join(tmpdir, os.path.pardir))
+		self.timeline.end(span)
 
-			ro_rmtree(tmpdir)
+		local_feed = os.path.join(site_package_dir, '0install', 'feed.xml')
+		assert os.path.exists(local_feed), "Feed %s not found!" % local_feed
+
+		with self.timeline.span(lane, 'register feed', feed = local_feed):
+			self.register_feed(forced_iface_uri, local_feed)
+
+		seen_key = (forced_iface_uri, source_impl_id)
+		assert seen_key not in self.seen, seen_key
+		self.seen[seen_key] = site_package_dir
+		self.journal.add('done', **journal_entry)
+
+	def register_feed(self, iface_uri, local_feed):
+		# Reload - our 0install will detect the new feed automatically
+		iface = self.config.iface_cache.get_interface(iface_uri)
+		reader.update_from_cache(iface, iface_cache = self.config.iface_cache)
+		self.config.iface_cache.get_feed(local_feed, force = True)
+
+		# Write it out - 0install will add the feed so that older 0install versions can find it
+		writer.save_interface(iface)
 
 	@tasks.aasync
-	def recursive_build(self, iface_uri, source_impl_id = None):
-		"""Build an implementation of iface_uri and register it as a feed.
-		@param source_impl_id: the version to build, or None to build any version
-		@type source_impl_id: str
-		"""
-		r = requirements.Requirements(iface_uri)
+	def solve(self, node):
+		"""Select the versions to use to build node. Build dependencies which haven't been compiled
+		yet will be selected as '0compile=SOURCE-ID' implementations."""
+		r = requirements.Requirements(node.iface_uri)
 		r.source = True
 		r.command = 'compile'
 
 		d = driver.Driver(self.config, r)
-		iface = self.config.iface_cache.get_interface(iface_uri)
+		iface = self.config.iface_cache.get_interface(node.iface_uri)
 		d.solver.record_details = True
-		if source_impl_id is not None:
-			d.solver.extra_restrictions[iface] = [ImplRestriction(source_impl_id)]
+		if node.source_impl_id is not None:
+			d.solver.extra_restrictions[iface] = [ImplRestriction(node.source_impl_id)]
 
 		# For testing...
 		#p.target_arch = arch.Architecture(os_ranks = {'FreeBSD': 0, None: 1}, machine_ranks = {'i386': 0, None: 1, 'newbuild': 2})
 
+		self.heading(node.iface_uri)
+		self.note("\nSelecting versions for %s..." % iface.get_name())
+		start = time.time()
+		try:
+			with self.timeline.span(node.lane, 'solve', interface = node.iface_uri):
+				solved = d.solve_with_downloads()
+				if solved:
+					yield solved
+					tasks.check(solved)
+		finally:
+			self.solve_count += 1
+			self.solve_time += time.time() - start
+
+		if not d.solver.ready:
+			self.print_details(d.solver)
+			raise d.solver.get_failure_reason()
+		self.note("Selection done.")
+
+		self.note("\nPlan:\n")
+		self.pretty_print_plan(d.solver, r.interface_uri)
+		self.note('')
+
+		node.requirements = r
+		node.solver = d.solver
+
+	def download_selection(self, sel):
+		"""Download sel if it isn't already cached. Returns a Blocker, or None if there's nothing to do."""
+		sels = selections.Selections(None)
+		sels.interface = sel.interface
+		sels.selections = {sel.interface: sel}
+		return sels.download_missing(self.config)
+
+	@tasks.aasync
+	def prefetch(self, nodes):
+		"""Start downloading everything selected for nodes in the background (running up to
+		self.prefetch_limit downloads at once), so that the downloads overlap with the builds.
+		Distribution packages are left until they're needed, as they may need confirmation."""
+		todo = []
+		for node in nodes:
+			for sel in node.solver.selections.selections.values():
+				key = (sel.feed, sel.id)
+				if key in self.prefetching or key in self.prefetch_queued or \
+						sel.id.startswith('0compile=') or sel.id.startswith('package:'):
+					continue
+				self.prefetch_queued.add(key)
+				todo.append((key, sel))
+
+		# Errors are only noted here; compile_and_register will try again and report the error,
+		# if we still need it. Whatever happens, every Blocker in self.prefetching must be
+		# triggered, or compile_and_register will wait for it forever.
+		def failed(key, ex):
+			self.note("Failed to prefetch {feed}: {ex}".format(feed = key[0], ex = ex))
+
+		running = {}		# key -> Blocker
+		lanes = {}		# key -> (timeline lane, span)
+		try:
+			while todo or running:
+				while todo and len(running) < self.prefetch_limit:
+					key, sel = todo.pop(0)
+					if key not in self.prefetch_queued:
+						continue		# (a build needed it before we got to it)
+					self.prefetch_queued.remove(key)
+					self.prefetching[key] = tasks.Blocker('prefetch %s' % sel.id)
+					try:
+						download = self.download_selection(sel)
+					except Exception as ex:
+						failed(key, ex)
+						download = None
+					if download:
+						running[key] = download
+						lane = self.timeline.get_lane('download')
+						lanes[key] = (lane, self.timeline.begin(lane, 'download', feed = key[0], id = key[1]))
+					else:
+						self.prefetching[key].trigger()
+				if not running:
+					break
+				yield list(running.values())
+				for key, download in list(running.items()):
+					if download.happened:
+						del running[key]
+						lane, span = lanes.pop(key)
+						self.timeline.end(span)
+						self.timeline.release_lane(lane)
+						try:
+							tasks.check(download)
+						except Exception as ex:
+							failed(key, ex)
+						self.prefetching[key].trigger()
+		finally:
+			for key, unused in todo:
+				self.prefetch_queued.discard(key)
+			for key in running:
+				self.prefetching[key].trigger()
+
+	def get_needed(self, node):
+		"""The (iface, source_id) pairs of the build dependencies selected by the last solve which need compiling."""
+		needed = []
+		for dep_iface_uri, dep_sel in sorted(node.solver.selections.selections.items()):
+			if dep_sel.id.startswith('0compile='):
+				if not needed:
+					self.note("Build dependencies that need to be compiled first:\n")
+				self.note("- {iface} {version}".format(iface = dep_iface_uri, version = dep_sel.version))
+				needed.append((dep_iface_uri, dep_sel.id.split('=', 1)[1]))
+		return needed
+
+	@tasks.aasync
+	def plan(self, node, path = ()):
+		"""Solve for node and (recursively) for each build dependency that needs compiling,
+		filling in the deps of each node."""
+		solve = self.solve(node)
+		yield solve
+		tasks.check(solve)
+
+		if node.source_impl_id is None:
+			node.source_impl_id = node.solver.selections.selections[node.iface_uri].id
+			self.nodes[node.key] = node
+
+		for dep_key in self.get_needed(node):
+			if dep_key in path + (node.key,):
+				raise SafeException("Build dependency cycle: {cycle}".format(
+					cycle = ' -> '.join('%s (%s)' % key for key in path + (node.key, dep_key))))
+			dep = self.nodes.get(dep_key, None)
+			if dep is None:
+				dep = self.nodes[dep_key] = BuildNode(*dep_key)
+				planned = self.plan(dep, path + (node.key,))
+				yield planned
+				tasks.check(planned)
+			node.deps.append(dep)
+
+		self.journal.planned(node)
+
+	def get_plan_order(self, root):
+		"""root and the build dependencies it needs which haven't been built yet, each after its own build dependencies."""
+		todo = []
+		def add(node):
+			if node not in todo and node not in self.built:
+				for dep in node.deps:
+					add(dep)
+				todo.append(node)
+		add(root)
+		return todo
+
+	def estimate_plan(self, root):
+		"""Set the estimate and priority of each node in root's plan, and return the estimated time to
+		build everything (assuming that we start the ready build with the highest priority whenever
+		fewer than self.parallel builds are running, as run_plan does)."""
+		order = self.get_plan_order(root)
+		for node in order:
+			version = node.solver.selections.selections[node.iface_uri].version
+			node.estimate = self.durations.estimate(node.iface_uri, version)
+
+		# A node's priority is the length of the critical path from it to the root, so the builds
+		# holding up the most other builds start first
+		for node in reversed(order):
+			dependents = [n for n in order if node in n.deps]
+			node.priority = (node.estimate or UNKNOWN_BUILD_TIME) + max([n.priority for n in dependents], default = 0)
+
+		now = 0
+		pending = list(order)
+		running = []		# (finish time, BuildNode)
+		finished = set()
+		while pending or running:
+			ready = [n for n in pending if all(dep in finished or dep in self.built for dep in n.deps)]
+			ready.sort(key = lambda n: -n.priority)
+			for node in ready[:self.parallel - len(running)]:
+				pending.remove(node)
+				running.append((now + (node.estimate or UNKNOWN_BUILD_TIME), node))
+			running.sort(key = lambda r: r[0])
+			now, node = running.pop(0)
+			finished.add(node)
+		return now
+
+	def get_plan_json(self, root, total):
+		builds = []
+		for node in self.get_plan_order(root):
+			builds.append({
+				'interface': node.iface_uri,
+				'source': node.source_impl_id,
+				'version': node.solver.selections.selections[node.iface_uri].version,
+				'depends': [[dep.iface_uri, dep.source_impl_id] for dep in node.deps],
+				'estimate': node.estimate,
+				'priority': node.priority,
+			})
+		return {
+			'interface': root.iface_uri,
+			'arch': self.durations.arch,
+			'parallel': self.parallel,
+			'critical-path': max([node['priority'] for node in builds], default = 0),
+			'estimated-time': total,
+			'builds': builds,
+		}
+
+	def finish_builds(self):
+		"""Record the result of each build which has finished (whichever run_plan started it)."""
+		for node, blocker in list(self.building.items()):
+			if blocker.happened:
+				del self.building[node]
+				try:
+					tasks.check(blocker)
+				except Exception as ex:
+					if not self.keep_going:
+						raise
+					if node not in self.failed:
+						self.failed[node] = ex
+						self.note_error("Failed to build {node}: {ex}".format(node = self.describe(node), ex = ex))
+				else:
+					self.built.add(node)
+
+	def count_running(self):
+		"""The number of builds in progress (not counting those waiting for a dependency to be built
+		by a nested run_plan). This is shared by all the run_plans, so --parallel limits the total."""
+		return len([b for b in self.building.values() if not b.happened]) - self.waiting
+
+	@tasks.aasync
+	def run_plan(self, root):
+		"""Build root and everything it depends on, starting each build as soon as its build
+		dependencies have been registered (running up to self.parallel builds at once, starting
+		the ones on the critical path first). With --keep-going, a failed build doesn't stop the
+		others: only the builds which need it are skipped."""
+		todo = self.get_plan_order(root)
+
 		while True:
-			self.heading(iface_uri)
-			self.note("\nSelecting versions for %s..." % iface.get_name())
-			solved = d.solve_with_downloads()
-			if solved:
-				yield solved
-				tasks.check(solved)
-
-			if not d.solver.ready:
-				self.print_details(d.solver)
-				raise d.solver.get_failure_reason()
-			self.note("Selection done.")
-
-			self.note("\nPlan:\n")
-			self.pretty_print_plan(d.solver, r.interface_uri)
-			self.note('')
-
-			needed = []
-			for dep_iface_uri, dep_sel in d.solver.selections.selections.items():
-				if dep_sel.id.startswith('0compile='):
-					if not needed:
-						self.note("Build dependencies that need to be compiled first:\n")
-					self.note("- {iface} {version}".format(iface = dep_iface_uri, version = dep_sel.version))
-					needed.append((dep_iface_uri, dep_sel))
-
-			if not needed:
-				self.note("No dependencies need compiling... compile %s itself..." % iface.get_name())
-				build = self.compile_and_register(d.solver.selections,
-						# force the interface in the recursive case
-						iface_uri if iface_uri != self.iface_uri else None)
-				yield build
-				tasks.check(build)
-				return
-
-			# Compile the first missing build dependency...
-			dep_iface_uri, dep_sel = needed[0]
-
-			self.note("")
-
-			#details = d.solver.details[self.config.iface_cache.get_interface(dep_iface.uri)]
-			#for de in details:
-			#	print de
-
-			dep_source_id = dep_sel.id.split('=', 1)[1]
-			seen_key = (dep_iface_uri, dep_source_id)
-			if seen_key in self.seen:
-				self.note_error("BUG: Stuck in an auto-compile loop: already built {key}!".format(key = seen_key))
-				# Try to find out why the previous build couldn't be used...
-				dep_iface = self.config.iface_cache.get_interface(dep_iface_uri)
-				previous_build = self.seen[seen_key]
-				previous_build_feed = os.path.join(previous_build, '0install', 'feed.xml')
-				previous_feed = self.config.iface_cache.get_feed(previous_build_feed)
-				previous_binary_impl = list(previous_feed.implementations.values())[0]
-				raise SafeException("BUG: auto-compile loop: expected to select previously-build binary {binary}:\n\n{reason}".format(
-						binary = previous_binary_impl,
-						reason = d.solver.justify_decision(r, dep_iface, previous_binary_impl)))
-
-			build = self.recursive_build(dep_iface_uri, dep_source_id)
+			self.finish_builds()
+			# (nodes may have been built or have failed in another run_plan meanwhile)
+			todo = [node for node in todo if node not in self.built and node not in self.failed]
+			for node in list(todo):		# (in build order, so a node's dependencies are skipped first)
+				failed_deps = [dep for dep in node.deps if dep in self.failed or dep in self.skipped]
+				if failed_deps:
+					todo.remove(node)
+					if node not in self.skipped:
+						self.skipped.add(node)
+						self.note_error("Skipping {node}, because {deps} failed".format(
+							node = self.describe(node), deps = ', '.join(self.describe(dep) for dep in failed_deps)))
+			if not todo:
+				break
+			for node in sorted(todo, key = lambda n: -n.priority):
+				if self.count_running() >= self.parallel:
+					break
+				if node not in self.building and all(dep in self.built for dep in node.deps):
+					self.building[node] = self.build_node(node)
+			pending = [b for b in self.building.values() if not b.happened]
+			assert pending, todo
+			yield pending
+
+	def describe(self, node):
+		sel = node.solver.selections.selections[node.iface_uri] if node.solver else None
+		return '%s %s' % (node.iface_uri, sel.version if sel else '(%s)' % node.source_impl_id)
+
+	def print_summary(self):
+		"""Show which builds were done, which failed and which were skipped (for --keep-going)."""
+		self.heading('Summary')
+		for title, nodes in [('Built', [n for n in self.nodes.values() if n in self.built]),
+				     ('Failed', [n for n in self.nodes.values() if n in self.failed]),
+				     ('Skipped', [n for n in self.nodes.values() if n in self.skipped])]:
+			self.note('%s (%d):' % (title, len(nodes)))
+			for node in nodes:
+				if node in self.failed:
+					self.note('- %s: %s' % (self.describe(node), self.failed[node]))
+				else:
+					self.note('- %s' % self.describe(node))
+
+	def use_new_builds(self, node):
+		"""Replace the 0compile= placeholders in node's selections with the binaries we built for them.
+		We can only do this if each new binary has the requirements that add_binary_deps predicted (so that
+		solving again would give the same result). Returns False, changing nothing, if not."""
+		sels = node.solver.selections
+		new_sels = {}
+		for dep in node.deps:
+			old_sel = sels.selections.get(dep.iface_uri, None)
+			site_package_dir = self.seen.get(dep.key, None)
+			if old_sel is None or old_sel.id != '0compile=' + dep.source_impl_id or site_package_dir is None:
+				return False
+
+			predicted = getattr(old_sel, 'impl', None)
+			if predicted is None:
+				return False		# (loaded from the journal; we didn't predict anything)
+
+			feed = self.config.iface_cache.get_feed(os.path.join(site_package_dir, '0install', 'feed.xml'))
+			impl, = feed.implementations.values()
+			used_commands = old_sel.get_commands()
+			if get_requirements(impl) != get_requirements(predicted) or \
+			   any(name not in impl.commands or get_requirements(impl.commands[name]) != get_requirements(predicted.commands[name])
+			       for name in used_commands):
+				self.note("The new binary for {iface} doesn't have the requirements we predicted; selecting versions again...".format(
+					iface = dep.iface_uri))
+				return False
+
+			new_sel = selections.ImplSelection(dep.iface_uri, impl, old_sel.dependencies)
+			for name in used_commands:
+				new_sel._used_commands[name] = impl.commands[name]
+			new_sels[dep.iface_uri] = new_sel
+
+		sels.selections.update(new_sels)
+		return True
+
+	@tasks.aasync
+	def build_node(self, node):
+		"""Compile node, whose build dependencies have all been registered."""
+		name = self.config.iface_cache.get_interface(node.iface_uri).get_name()
+		self.journal.add('started', interface = node.iface_uri, source = node.source_impl_id)
+		with self.timeline.lane('build') as node.lane, \
+		     self.timeline.span(node.lane, 'build %s' % name, interface = node.iface_uri, source = node.source_impl_id):
+			resolve = node.deps and not self.use_new_builds(node)
+			while resolve:
+				# Solve again, so we select the new binaries instead of the 0compile= placeholders
+				solve = self.solve(node)
+				yield solve
+				tasks.check(solve)
+
+				needed = self.get_needed(node)
+				if not needed:
+					break
+
+				self.note("")
+				for dep_key in needed:
+					if dep_key in self.seen:
+						self.note_error("BUG: Stuck in an auto-compile loop: already built {key}!".format(key = dep_key))
+						# Try to find out why the previous build couldn't be used...
+						dep_iface_uri, dep_source_id = dep_key
+						dep_iface = self.config.iface_cache.get_interface(dep_iface_uri)
+						previous_build = self.seen[dep_key]
+						previous_build_feed = os.path.join(previous_build, '0install', 'feed.xml')
+						previous_feed = self.config.iface_cache.get_feed(previous_build_feed)
+						previous_binary_impl = list(previous_feed.implementations.values())[0]
+						raise SafeException("BUG: auto-compile loop: expected to select previously-build binary {binary}:\n\n{reason}".format(
+								binary = previous_binary_impl,
+								reason = node.solver.justify_decision(node.requirements, dep_iface, previous_binary_impl)))
+
+				# The binaries we built need something else compiled too. Build that and try again...
+				for dep_key in needed:
+					dep = self.nodes.get(dep_key, None)
+					if dep is None:
+						dep = self.nodes[dep_key] = BuildNode(*dep_key)
+						planned = self.plan(dep, (node.key,))
+						yield planned
+						tasks.check(planned)
+					node.deps.append(dep)
+					build = self.run_plan(dep)
+					self.waiting += 1	# (we're not using a build slot while we wait)
+					try:
+						yield build
+					finally:
+						self.waiting -= 1
+					tasks.check(build)
+					if dep not in self.built:
+						raise SafeException("Can't build {node}, because {dep} failed".format(
+							node = self.describe(node), dep = self.describe(dep)))
+				self.journal.planned(node)
+
+			# force the interface in the recursive case
+			forced_iface_uri = node.iface_uri if node.iface_uri != self.iface_uri else None
+
+			if self.binary_cache:
+				cached = self.binary_cache.lookup(node.solver.selections)
+				if cached:
+					self.note("Using existing build of %s from %s" % (name, cached))
+					self.register(node.solver.selections, cached, os.path.join(cached, '0install', 'feed.xml'),
+							forced_iface_uri, copy = True, lane = node.lane)
+					return
+
+			self.note("No dependencies need compiling... compile %s itself..." % name)
+			build = self.compile_and_register(node.solver.selections, forced_iface_uri, lane = node.lane)
 			yield build
 			tasks.check(build)
 
-			assert seen_key in self.seen, (seen_key, self.seen)	# Must have been built by now
-
-			# Try again with that dependency built...
+	@tasks.aasync
+	def recursive_build(self, iface_uri, source_impl_id = None):
+		"""Build an implementation of iface_uri and register it as a feed.
+		@param source_impl_id: the version to build, or None to build any version
+		@type source_impl_id: str
+		"""
+		root = None
+		if self.options.resume:
+			root = self.resume()
+		if root is None:
+			if not self.options.plan_only:
+				self.journal.start()
+			root = BuildNode(iface_uri, source_impl_id)
+			with self.timeline.span(0, 'plan'):
+				planned = self.plan(root)
+				yield planned
+				tasks.check(planned)
+			self.journal.add('ready', interface = root.iface_uri, source = root.source_impl_id)
+
+		total = self.estimate_plan(root)
+		order = self.get_plan_order(root)
+		if root.deps:
+			self.note("Build order: %d builds, up to %d at a time" % (len(self.nodes), self.parallel))
+			for node in order:
+				self.note("- {iface} {version}{estimate}".format(
+					iface = node.iface_uri,
+					version = node.solver.selections.selections[node.iface_uri].version,
+					estimate = '' if node.estimate is None else ' [about %s]' % format_duration(node.estimate)))
+		untimed = [node for node in order if node.estimate is None]
+		if len(untimed) == len(order):
+			self.note("Estimated time: unknown (not built on this machine before)")
+		elif untimed:
+			self.note("Estimated time: about {total} (assuming {guess} for each of the {n} builds not timed before)".format(
+				total = format_duration(total), guess = format_duration(UNKNOWN_BUILD_TIME), n = len(untimed)))
+		else:
+			self.note("Estimated time: about %s" % format_duration(total))
+
+		if self.options.plan_only:
+			if self.options.json:
+				json.dump(self.get_plan_json(root, total), sys.stdout, indent = 2)
+				print()
+			return
+
+		if self.prefetch_limit:
+			# (in the background, starting with the sources on the critical path)
+			self.prefetch(sorted(self.nodes.values(), key = lambda n: -n.priority))
+
+		build = self.run_plan(root)
+		yield build
+		tasks.check(build)
+
+		self.note("Selected versions {n} times, taking {time:.1f} s in total".format(
+			n = self.solve_count, time = self.solve_time))
+
+		if self.keep_going:
+			self.print_summary()
+			if self.failed:
+				raise SafeException("{failed} of {total} builds failed ({skipped} skipped); use --resume to try them again".format(
+					failed = len(self.failed), total = len(self.nodes), skipped = len(self.skipped)))
+
+		self.journal.remove()
+
+	def resume(self):
+		"""Load the plan of an interrupted run from the journal, marking the builds it finished as built
+		(after checking that they're still in site-packages). Returns the root node, or None if
+		there's nothing to resume."""
+		entries = self.journal.load()
+		ready = [entry for entry in entries or [] if entry['event'] == 'ready']
+		if not ready:
+			self.note("No interrupted run of %s to resume; starting from the beginning" % self.iface_uri)
+			return None
+
+		planned = {}		# key -> entry (the last one for each node)
+		started = []		# keys, in order
+		installed = {}		# key -> entry
+		done = set()		# keys
+		for entry in entries:
+			key = (entry.get('interface'), entry.get('source'))
+			if entry['event'] == 'planned':
+				planned[key] = entry
+			elif entry['event'] == 'started':
+				started.append(key)
+			elif entry['event'] == 'installed':
+				installed[key] = entry
+			elif entry['event'] == 'done':
+				done.add(key)
 
-	def spawn_build(self, iface_name):
 		try:
-			subprocess.check_call([sys.executable, sys.argv[0], 'build'])
+			for key, entry in planned.items():
+				node = self.nodes[key] = BuildNode(*key)
+				node.solver = ResumedSolve(selections.Selections(qdom.parse(io.BytesIO(entry['selections'].encode('utf-8')))))
+			for key, entry in planned.items():
+				self.nodes[key].deps = [self.nodes[tuple(dep)] for dep in entry['deps']]
+			root = self.nodes[(ready[-1]['interface'], ready[-1]['source'])]
+		except (KeyError, ExpatError, SafeException) as ex:
+			self.note("Can't resume from %s (%s); starting from the beginning" % (self.journal.path, ex))
+			self.nodes.clear()
+			return None
+
+		for key, entry in installed.items():
+			node = self.nodes.get(key, None)
+			if node is None:
+				continue
+			local_feed = os.path.join(entry['dir'], '0install', 'feed.xml')
+			version = node.solver.selections.selections[node.iface_uri].version
+			if not self.verify_build(local_feed, version):
+				self.note("Build of %s in %s has gone; building it again" % (self.describe(node), entry['dir']))
+				continue
+			if key not in done:
+				self.register_feed(entry['registered_as'], local_feed)
+			self.seen[(entry['registered_as'], node.source_impl_id)] = entry['dir']
+			self.built.add(node)
+
+		interrupted = [self.nodes[key] for key in started if key in self.nodes and self.nodes[key] not in self.built]
+		for node in interrupted:
+			self.note("Build of %s didn't finish last time; building it again" % self.describe(node))
+
+		self.note("Resuming the interrupted run: {done} of {total} builds already done".format(
+			done = len(self.built), total = len(self.nodes)))
+		if not self.options.plan_only:
+			self.journal.active = True
+		return root
+
+	def verify_build(self, local_feed, version):
+		"""Check that the feed of a build in site-packages is still there, without rebuilding it."""
+		if not os.path.exists(local_feed):
+			return False
+		try:
+			feed = self.config.iface_cache.get_feed(local_feed, force = True)
+		except SafeException as ex:
+			warn("%s", ex)
+			return False
+		return feed is not None and [impl.get_version() for impl in feed.implementations.values()] == [version]
+
+	def spawn_build(self, iface_name, tmpdir):
+		if (self.parallel > 1 or self.prefetch_limit) and os.name != 'nt':
+			# (don't block the main loop, so that other builds and prefetch downloads can continue;
+			# not on Windows, which can't wait for the output of a child in the main loop)
+			return self.spawn_background_build(iface_name, tmpdir)
+		try:
+			subprocess.check_call([sys.executable, sys.argv[0], 'build'], cwd = tmpdir)
 		except subprocess.CalledProcessError as ex:
 			raise SafeException(str(ex))
 
-	def build(self):
+	@tasks.aasync
+	def spawn_background_build(self, iface_name, tmpdir):
+		"""Run the build in the background, showing its output (with each line prefixed by iface_name,
+		if other builds may be running at the same time)."""
+		prefix = '[%s] ' % iface_name if self.parallel > 1 else ''
+
+		# Group the build's processes so stop_builds can kill them all
+		def become_group_leader():
+			os.setpgid(0, 0)
+		devnull = os.open(os.devnull, os.O_RDONLY)
+		try:
+			child = subprocess.Popen([sys.executable, '-u', sys.argv[0], 'build'],
+							cwd = tmpdir,
+							stdin = devnull,
+							stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
+							preexec_fn = become_group_leader)
+		finally:
+			os.close(devnull)
+		self.children.add(child)
+
+		import codecs
+		decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+
+		partial = ''
+		while True:
+			yield tasks.InputBlocker(child.stdout, 'output from %s build' % iface_name)
+			got = os.read(child.stdout.fileno(), 4096)
+			lines = (partial + decoder.decode(got, final = not got)).split('\n')
+			partial = lines.pop()
+			for line in lines:
+				self.note(prefix + line)
+			if not got: break
+		if partial:
+			self.note(prefix + partial)
+
+		child.stdout.close()
+		child.wait()
+		self.children.discard(child)
+		if child.returncode:
+			raise SafeException('Build of %s exited with error status %d' % (iface_name, child.returncode))
+
+	def stop_builds(self):
+		"""Kill any background builds still running (after another build failed, or we were interrupted)."""
+		for child in list(self.children):
+			if child.poll() is None:
+				self.note_error('Sending TERM signal to build process group %d...' % child.pid)
+				try:
+					os.kill(-child.pid, signal.SIGTERM)
+				except OSError as ex:
+					warn("Failed to kill build process group %d: %s", child.pid, ex)
+			child.wait()
+			child.stdout.close()
+		self.children.clear()
+
+	def start_build(self):
 		self.seen = {}
-		tasks.wait_for_blocker(self.recursive_build(self.iface_uri))
+		self.nodes = {}
+		self.built = set()
+		self.building = {}
+		self.waiting = 0
+		self.failed = {}
+		self.skipped = set()
+		self.solve_count = 0
+		self.solve_time = 0.0
+		self.prefetching = {}
+		self.prefetch_queued = set()
+		self.children = set()
+		return self.recursive_build(self.iface_uri)
+
+	def build(self):
+		try:
+			tasks.wait_for_blocker(self.start_build())
+		except BaseException:
+			self.stop_builds()
+			raise
 
 	def heading(self, msg):
 		self.note((' %s ' % msg).center(76, '='))
 
 	def note(self, msg):
-		print(msg)
+		print(msg, file = self.output)
 
 	def note_error(self, msg):
-		print(msg)
+		print(msg, file = self.output)
 
 class GUIHandler(handler.Handler):
 	def downloads_changed(self):
@@ -515,10 +1357,9 @@ class GTKAutoCompiler(AutoCompiler):
 		self.overall.insert_at_end_and_scroll(msg + '\n', 'error')
 
 	def build(self):
-		self.seen = {}
 		import gtk
 		try:
-			tasks.wait_for_blocker(self.recursive_build(self.iface_uri))
+			tasks.wait_for_blocker(self.start_build())
 		except SafeException as ex:
 			self.note_error(str(ex))
 		else:
@@ -529,7 +1370,7 @@ class GTKAutoCompiler(AutoCompiler):
 		tasks.wait_for_blocker(self.closed)
 
 	@tasks.aasync
-	def spawn_build(self, iface_name):
+	def spawn_build(self, iface_name, tmpdir):
 		assert self.child is None
 
 		self.details.insert_at_end_and_scroll('Building %s\n' % iface_name, 'heading')
@@ -540,6 +1381,7 @@ class GTKAutoCompiler(AutoCompiler):
 		devnull = os.open(os.devnull, os.O_RDONLY)
 		try:
 			self.child = subprocess.Popen([sys.executable, '-u', sys.argv[0], 'build'],
+							cwd = tmpdir,
 							stdin = devnull,
 							stdout = subprocess.PIPE, stderr = subprocess.STDOUT,
 							preexec_fn = become_group_leader)
@@ -565,14 +1407,33 @@ class GTKAutoCompiler(AutoCompiler):
 		self.details.insert_at_end_and_scroll('Build completed successfully\n', 'heading')
 
 def do_autocompile(args):
-	"""autocompile [--gui] URI"""
+	"""autocompile [--gui] [--parallel N] [--prefetch N] [--binary-cache DIR] [--keep-going] [--resume] [--plan-only [--json]] [--trace FILE] URI"""
 
 	parser = OptionParser(usage="usage: %prog autocompile [options]")
 
 	parser.add_option('', "--gui", help="graphical interface", action='store_true')
+	parser.add_option('-k', "--keep-going", help="if a build fails, continue with the builds that don't need it", action='store_true')
+	parser.add_option('', "--resume", help="continue an interrupted run from where it stopped", action='store_true')
+	parser.add_option('', "--binary-cache", help="reuse (and save) builds in DIR", metavar='DIR',
+			default = os.environ.get('ZI_COMPILE_BINARY_CACHE', None))
+	parser.add_option('', "--parallel", help="run up to N independent builds at once", type='int', default=1, metavar='N')
+	parser.add_option('', "--prefetch", help="download up to N sources and dependencies at once in the background (default 4; 0 to disable)", type='int', default=4, metavar='N')
+	parser.add_option('', "--plan-only", help="show what would be built, and how long it should take, without building anything", action='store_true')
+	parser.add_option('', "--json", help="with --plan-only, write the plan to stdout as JSON", action='store_true')
+	parser.add_option('', "--trace", help="write a timeline of the run to FILE (in Chrome's trace event format)", metavar='FILE')
 	(options, args2) = parser.parse_args(args)
 	if len(args2) != 1:
 		raise __main__.UsageError()
+	if options.parallel < 1:
+		raise SafeException("--parallel must be at least 1")
+	if options.prefetch < 0:
+		raise SafeException("--prefetch can't be negative")
+	if options.gui and options.parallel > 1:
+		raise SafeException("--parallel can't be used with --gui")
+	if options.gui and options.plan_only:
+		raise SafeException("--plan-only can't be used with --gui")
+	if options.json and not options.plan_only:
+		raise SafeException("--json can only be used with --plan-only")
 
 	if options.gui:
 		h = GUIHandler()
@@ -583,6 +1444,9 @@ def do_autocompile(args):
 	config = load_config(handler = h)
 	config._iface_cache = AutocompileCache()
 
+	# (we record the duration of each build, including registering it, ourselves)
+	os.environ[support.DURATION_RECORDED_ENV] = '1'
+
 	iface_uri = model.canonical_iface_uri(args2[0])
 	if options.gui:
 		compiler = GTKAutoCompiler(config, iface_uri, options)
@@ -590,6 +1454,9 @@ def do_autocompile(args):
 	else:
 		compiler = AutoCompiler(config, iface_uri, options)
 
-	compiler.build()
+	try:
+		compiler.build()
+	finally:
+		compiler.timeline.save(options.trace)
 
 __main__.commands += [do_autocompile]
@@ -4,16 +4,16 @@
 import os, __main__, codecs
 from os.path import join
 
-from support import BuildEnv
+from support import BuildEnv, find_build_log, open_build_log
 
 def do_report_bug(args):
 	"""report-bug"""
 	buildenv = BuildEnv()
 
-	log_name = join('build', 'build-failure.log')
-	build_log = codecs.open(log_name, 'r', 'utf-8')
-	log_text = build_log.read()
-	build_log.close()
+	log_stem = join('build', 'build-failure.log')
+	log_name = find_build_log(log_stem) or log_stem
+	with open_build_log(log_name) as build_log:
+		log_text = build_log.read()
 
 	build_env_xml_file = join(buildenv.metadir, 'build-environment.xml')
 	if os.path.exists(build_env_xml_file):
@@ -1,7 +1,7 @@
 # Copyright (C) 2006, Thomas Leonard
 # See http://0install.net/0compile.html
 
-import sys, os, __main__, time, shutil, glob, codecs, subprocess
+import sys, os, __main__, time, shutil, glob, codecs, subprocess, hashlib, json, re
 from os.path import join
 from logging import info, warn
 from xml.dom import minidom, XMLNS_NAMESPACE
@@ -12,13 +12,41 @@ import itertools
 from zeroinstall import SafeException
 from zeroinstall.injector import model, namespaces, run
 from zeroinstall.injector.iface_cache import iface_cache
+from zeroinstall.support import basedir
 
 from support import BuildEnv, ensure_dir, XMLNS_0COMPILE, is_package_impl, parse_bool, depth, uname
 from support import spawn_and_check, find_in_path, ENV_FILE, lookup, spawn_and_check_maybe_sandboxed, Prefixes
+from support import LOG_COMPRESSION, open_build_log, find_build_log, trace, TRACE_FILE, parse_jobs
+from support import BUILDDIR_ENV, STAGING_DISTDIR_ENV, SELECTIONS_ENV, SPAWN_TIME_ENV, copy_file, copy_tree
+from support import RAM_BUILD_FS, get_ram_build_root
+from support import load_json_cache, save_json_cache, BuildDurations, DURATION_RECORDED_ENV
+
+# How much of the child's output to read at once when copying it to the log
+TEE_CHUNK_SIZE = 64 * 1024
+
+# The patch between the original source and the user's src directory is copied into the build log,
+# up to this many characters
+PATCH_LOG_LIMIT = 1024 * 1024
+
+# The diff of each changed file in src is cached here (in $BUILDDIR), so rebuilds only diff changed files
+PATCH_INDEX = '.0compile-patch.json'
 
 # If we have to modify any pkg-config files, we put the new versions in $TMPDIR/PKG_CONFIG_OVERRIDES
+# (for immutable implementations, these are symlinks into the cache of the same name in $XDG_CACHE_HOME)
 PKG_CONFIG_OVERRIDES = 'pkg-config-overrides'
 
+# After a successful build, the fingerprint of its inputs is saved here (in $BUILDDIR, next to build-success.log)
+FINGERPRINT_FILE = 'build-fingerprint'
+
+# The library directory listings used for lib-mappings are cached here (in $XDG_CACHE_HOME/0install.net/0compile)
+LIBDIR_INDEX_CACHE = 'libdir-index.json'
+
+# The results of find_broken_version_symlinks for stored implementations, by digest
+BROKEN_SYMLINKS_CACHE = 'broken-symlinks.json'
+
+# How many pkg-config directories had their overrides in the cache (hits) or had to be scanned (misses)
+pc_override_stats = {'hits': 0, 'misses': 0}
+
 def env(name, value):
 	os.environ[name] = value
 	print("%s=%s" % (name, value))
@@ -43,12 +71,48 @@ def correct_for_64bit(base, rel_path):
 
 def write_pc(name, lines):
 	overrides_dir = os.path.join(os.environ['TMPDIR'], PKG_CONFIG_OVERRIDES)
-	if not os.path.isdir(overrides_dir):
-		os.mkdir(overrides_dir)
+	os.makedirs(overrides_dir, exist_ok = True)	# (may be called from several fixup threads)
 	stream = open(os.path.join(overrides_dir, name), 'w')
 	stream.write(''.join(lines))
 	stream.close()
 
+def rewrite_pc_files(pc_dir, path, feed_name):
+	"""Find .pc files in pc_dir with an absolute prefix and point them at path instead.
+	Returns a dict mapping the names of the files that needed changing to their new lines."""
+	rewritten = {}
+	for pc in os.listdir(pc_dir):
+		stream = open(os.path.join(pc_dir, pc))
+		lines = stream.readlines()
+		stream.close()
+		for i, line in enumerate(lines):
+			if '=' not in line: continue
+			name, value = [x.strip() for x in line.split('=', 1)]
+			if name == 'prefix' and os.path.isabs(value):
+				print("Absolute prefix=%s in %s; overriding..." % (value, feed_name))
+				lines[i] = 'prefix=' + os.path.join(
+					path, os.path.splitdrive(value)[1][1:]) +'\n'
+				rewritten[pc] = lines
+				break
+	return rewritten
+
+def get_pc_override_cache(impl, path, pc_dir):
+	"""The directory in which the rewritten .pc files for pc_dir (in impl's directory, path) are cached, or None
+	if impl isn't immutable. The rewritten files depend only on the implementation's
+	digest and where it is stored, so the cache is shared between builds."""
+	if impl.local_path is not None:
+		return None
+	key = hashlib.sha256(pc_dir.encode('utf-8', 'surrogateescape')).hexdigest()[:32]
+	cache_root = basedir.save_cache_path('0install.net', '0compile', PKG_CONFIG_OVERRIDES)
+	return os.path.join(cache_root, os.path.basename(path) + '-' + key)
+
+def link_pc(name, target):
+	overrides_dir = os.path.join(os.environ['TMPDIR'], PKG_CONFIG_OVERRIDES)
+	os.makedirs(overrides_dir, exist_ok = True)
+	link = os.path.join(overrides_dir, name)
+	if os.path.lexists(link):
+		os.unlink(link)
+	os.symlink(target, link)
+
 def do_pkg_config_binding(binding, impl):
 	if impl.id.startswith('package:'):
 		return		# No bindings needed for native packages
@@ -64,19 +128,30 @@ def do_pkg_config_binding(binding, impl):
 
 	orig_path = os.path.join(path, binding.insert)
 	if os.path.isdir(orig_path):
-		for pc in os.listdir(orig_path):
-			stream = open(os.path.join(orig_path, pc))
-			lines = stream.readlines()
-			stream.close()
-			for i, line in enumerate(lines):
-				if '=' not in line: continue
-				name, value = [x.strip() for x in line.split('=', 1)]
-				if name == 'prefix' and os.path.isabs(value):
-					print("Absolute prefix=%s in %s; overriding..." % (value, feed_name))
-					lines[i] = 'prefix=' + os.path.join(
-						path, os.path.splitdrive(value)[1][1:]) +'\n'
-					write_pc(pc, lines)
-					break
+		cache_dir = get_pc_override_cache(impl, path, orig_path)
+		if cache_dir and os.path.isdir(cache_dir):
+			pc_override_stats['hits'] += 1
+			for pc in os.listdir(cache_dir):
+				info("Using cached override of %s from %s", pc, feed_name)
+				link_pc(pc, os.path.join(cache_dir, pc))
+		else:
+			pc_override_stats['misses'] += 1
+			rewritten = rewrite_pc_files(orig_path, path, feed_name)
+			for pc, lines in rewritten.items():
+				write_pc(pc, lines)
+			if cache_dir:
+				tmp_cache_dir = None
+				try:
+					tmp_cache_dir = tempfile.mkdtemp(prefix = '.new-', dir = os.path.dirname(cache_dir))
+					for pc, lines in rewritten.items():
+						with open(os.path.join(tmp_cache_dir, pc), 'w') as stream:
+							stream.write(''.join(lines))
+					os.rename(tmp_cache_dir, cache_dir)
+				except OSError as ex:
+					# (e.g. another build cached it first)
+					info("Failed to cache pkg-config overrides for %s: %s", feed_name, ex)
+					if tmp_cache_dir:
+						shutil.rmtree(tmp_cache_dir, ignore_errors = True)
 	do_env_binding(binding, path)
 
 def shorten_dynamic_library_install_name(dylib_file):
@@ -95,15 +170,6 @@ def shorten_dynamic_library_install_name(dylib_file):
 	shortname = os.path.basename(dylib_file)
 	subprocess.check_call(['install_name_tool', '-id', shortname, dylib_file])
 
-# After doing a build, remove the (dist) directory component from dynamic libraries
-def shorten_dynamic_library_install_names():
-	for root, dirs, files in os.walk(os.environ['DISTDIR']):
-		if os.path.basename(root) == 'lib':
-			for f in files:
-				if f.endswith('.dylib'):
-					info("Checking dynamic library '%s'", f)
-					shorten_dynamic_library_install_name(os.path.join(root, f))
-
 def fixup_generated_pkgconfig_file(pc_file):
 	stream = open(pc_file)
 	lines = stream.readlines()
@@ -119,40 +185,165 @@ def fixup_generated_pkgconfig_file(pc_file):
 			write_pc(pc_file, lines)
 			break
 
-# After doing a build, check that we didn't generate pkgconfig files with absolute paths
-# Rewrite if so
-def fixup_generated_pkgconfig_files():
-	for root, dirs, files in os.walk(os.environ['DISTDIR']):
-		if os.path.basename(root) == 'pkgconfig':
-			for f in files:
-				if f.endswith('.pc'):
-					info("Checking generated pkgconfig file '%s'", f)
-					fixup_generated_pkgconfig_file(os.path.join(root, f))
+# The libtool marker appears in the first few lines of the header
+LA_MARKER = 'Please DO NOT delete this file'
+LA_HEADER_SIZE = 1024
 
 def remove_la_file(path):
-	# Read the contents...
-	stream = open(path)
-	data = stream.read()
-	stream.close()
+	# Read the start of the header...
+	with open(path, 'rb') as stream:
+		header = stream.read(LA_HEADER_SIZE).decode('utf-8', 'replace')
 
 	# Check it really is a libtool archive...
-	if 'Please DO NOT delete this file' not in data:
+	if LA_MARKER not in header:
 		warn("Ignoring %s; doesn't look like a libtool archive", path)
 		return
 
 	os.unlink(path)
 	print("Removed %s (.la files contain absolute paths)" % path)
 
-# libtool archives contain hard-coded paths. Lucky, modern systems don't need them, so remove
-# them.
-def remove_la_files():
-	for root, dirs, files in os.walk(os.environ['DISTDIR']):
-		if os.path.basename(root) == 'lib':
+def warn_static_archive(path):
+	warn("Found static archive '%s'; maybe build with --disable-static?", os.path.basename(path))
+
+# After doing a build, each file in $DISTDIR is passed to the fixups registered for it here.
+# Entries are (parent directory name, file suffix, fixup name, handler).
+post_build_fixups = [
+	# Remove the (dist) directory component from dynamic libraries
+	('lib', '.dylib', 'shorten-install-names', shorten_dynamic_library_install_name),
+	# Check that we didn't generate pkgconfig files with absolute paths; rewrite if so
+	('pkgconfig', '.pc', 'fixup-pkgconfig', fixup_generated_pkgconfig_file),
+	# libtool archives contain hard-coded paths. Lucky, modern systems don't need them, so remove
+	# them.
+	('lib', '.la', 'remove-la-files', remove_la_file),
+	('lib', '.a', 'check-static-archives', warn_static_archive),
+]
+
+def run_post_build_fixups(distdir):
+	"""Walk distdir once, running the matching post_build_fixups for each file on a
+	pool of worker threads. Reports the time spent in each fixup."""
+	from concurrent.futures import ThreadPoolExecutor
+	import threading
+
+	timings = dict((x[2], [0, 0.0]) for x in post_build_fixups)
+	timings_lock = threading.Lock()
+
+	def run_fixup(name, fn, path):
+		start = time.time()
+		try:
+			fn(path)
+		finally:
+			with timings_lock:
+				timing = timings[name]
+				timing[0] += 1
+				timing[1] += time.time() - start
+
+	start = time.time()
+	with ThreadPoolExecutor() as pool:
+		jobs = []
+		for root, dirs, files in os.walk(distdir):
+			dirname = os.path.basename(root)
 			for f in files:
-				if f.endswith('.la'):
-					remove_la_file(os.path.join(root, f))
-				if f.endswith('.a'):
-					warn("Found static archive '%s'; maybe build with --disable-static?", f)
+				for fixup_dir, suffix, name, fn in post_build_fixups:
+					if dirname == fixup_dir and f.endswith(suffix):
+						info("Running %s on '%s'", name, f)
+						jobs.append(pool.submit(run_fixup, name, fn, os.path.join(root, f)))
+		for job in jobs:
+			job.result()
+
+	for name, (count, elapsed) in sorted(timings.items()):
+		if count:
+			info("Post-build fixup %s: %d files in %.3fs", name, count, elapsed)
+	info("Post-build fixups took %.3fs", time.time() - start)
+
+def set_up_compiler_cache(sels):
+	"""Point $CC and $CXX at wrappers which use compiler_cache.py.
+	The cache key includes the digest of the selections, so changing a dependency
+	doesn't reuse objects compiled against the old version."""
+	import cache, compiler_cache, shlex
+
+	if os.name == 'nt':
+		raise SafeException("--compiler-cache is not supported on Windows")
+
+	digest = hashlib.sha256()
+	for iface, sel in sorted(sels.selections.items()):
+		digest.update(('%s %s %s\n' % (iface, sel.id, sel.version)).encode('utf-8'))
+
+	cc = cache.get_compiler_cache()
+	env('ZI_COMPILE_CACHE_DIR', cc.cache_dir)
+	env('ZI_COMPILE_CACHE_KEY', digest.hexdigest())
+
+	wrappers_dir = os.path.join(os.environ['TMPDIR'], 'compiler-cache')
+	if not os.path.isdir(wrappers_dir):
+		os.mkdir(wrappers_dir)
+	for var, default in [('CC', 'cc'), ('CXX', 'c++')]:
+		real = shlex.split(os.environ.get(var, default))
+		wrapper = os.path.join(wrappers_dir, default)
+		with open(wrapper, 'w') as stream:
+			stream.write('#!/bin/sh\nexec %s "$@"\n' % ' '.join(shlex.quote(x) for x in
+				[sys.executable, os.path.abspath(compiler_cache.__file__)] + real))
+		os.chmod(wrapper, 0o755)
+		env(var, wrapper)
+	return cc
+
+def _add_jobs_flag(flags, jobs):
+	"""Add -jN to the inherited flags. It goes after them, because the last -j wins, but
+	before any ' -- ' (MAKEFLAGS puts command-line variable definitions after that)."""
+	flags, sep, variables = (' ' + flags).partition(' -- ')
+	return ('%s -j%d%s%s' % (flags, jobs, sep, variables)).strip()
+
+def set_jobs(jobs):
+	"""Tell the build tools how many jobs to run in parallel."""
+	env('MAKEFLAGS', _add_jobs_flag(os.environ.get('MAKEFLAGS', ''), jobs))
+	env('NINJAFLAGS', _add_jobs_flag(os.environ.get('NINJAFLAGS', ''), jobs))
+	env('CMAKE_BUILD_PARALLEL_LEVEL', str(jobs))
+
+def wait_with_rusage(child):
+	"""Wait for the child process to exit.
+	Returns its status (as for Popen.wait) and its resource usage (or None if not available)."""
+	if not hasattr(os, 'wait4'):
+		return child.wait(), None		# Windows
+	pid, status, rusage = os.wait4(child.pid, 0)
+	if os.WIFSIGNALED(status):
+		child.returncode = -os.WTERMSIG(status)
+	else:
+		child.returncode = os.WEXITSTATUS(status)
+	return child.returncode, rusage
+
+def get_resource_usage(rusage):
+	"""Convert a resource usage structure to a list of (attribute, value) pairs for <compile:build-info>."""
+	max_rss = rusage.ru_maxrss
+	if sys.platform == 'darwin':
+		max_rss //= 1024	# (bytes, not kilobytes)
+	return [
+		('user-time', '%.2f' % rusage.ru_utime),
+		('system-time', '%.2f' % rusage.ru_stime),
+		('max-rss-kb', str(max_rss)),
+		('block-input', str(rusage.ru_inblock)),
+		('block-output', str(rusage.ru_oublock)),
+		('voluntary-context-switches', str(rusage.ru_nvcsw)),
+		('involuntary-context-switches', str(rusage.ru_nivcsw)),
+	]
+
+def tee_output(stream, log):
+	"""Copy everything from the (binary) stream to stdout and to log until EOF.
+	Returns the number of bytes copied."""
+	decoder = codecs.getincrementaldecoder('utf-8')(errors = 'replace')
+	fd = stream.fileno()
+	total = 0
+	start = time.time()
+	while True:
+		data = os.read(fd, TEE_CHUNK_SIZE)
+		chars = decoder.decode(data, final = not data)
+		if chars:
+			sys.stdout.write(chars)
+			log.write(chars)
+		if not data: break
+		total += len(data)
+	sys.stdout.flush()
+	elapsed = time.time() - start
+	if elapsed > 0:
+		info("Copied %d bytes of build output in %.2fs (%.1f MB/s)", total, elapsed, total / elapsed / 1e6)
+	return total
 
 class CompileSetup(run.Setup):
 	def do_binding(self, impl, b, iface):
@@ -169,12 +360,14 @@ def do_build_internal(options, args):
 	# If a sandbox is being used, we're in it now.
 	import getpass, socket
 
+	trace.phase('load-selections')
 	buildenv = BuildEnv()
 	sels = buildenv.get_selections()
 
-	builddir = os.path.realpath('build')
+	builddir = os.environ.get(BUILDDIR_ENV, None) or os.path.realpath('build')
 	ensure_dir(buildenv.metadir)
 
+	trace.phase('write-build-environment')
 	build_env_xml = join(buildenv.metadir, 'build-environment.xml')
 
 	buildenv_doc = sels.toDOM()
@@ -187,8 +380,12 @@ def do_build_internal(options, args):
 	info.setAttributeNS(None, 'host', socket.getfqdn())
 	info.setAttributeNS(None, 'user', getpass.getuser())
 	info.setAttributeNS(None, 'arch', '%s-%s' % (uname[0], uname[4]))
-	with open (build_env_xml, 'w') as stream:
-		buildenv_doc.writexml(stream, addindent="  ", newl="\n")
+	def save_build_env_xml():
+		with open (build_env_xml, 'w') as stream:
+			buildenv_doc.writexml(stream, addindent="  ", newl="\n")
+	save_build_env_xml()
+
+	trace.phase('write-sample-feed')
 
 	# Create local binary interface file.
 	# We use the main feed for the interface as the template for the name,
@@ -205,14 +402,10 @@ def do_build_internal(options, args):
 				(master_feed.get_name(), src_impl.version, model.format_version(min_version), __main__.version))
 
 	# Create the patch
+	trace.phase('create-patch')
 	patch_file = join(buildenv.metadir, 'from-%s.patch' % src_impl.version)
 	if buildenv.user_srcdir:
-		with open(patch_file, 'w') as stream:
-			# (ignore errors; will already be shown on stderr)
-			try:
-				subprocess.call(["diff", "-urN", buildenv.orig_srcdir, 'src'], stdout = stream)
-			except OSError as ex:
-				print("WARNING: Failed to run 'diff': ", ex, file=sys.stderr)
+		update_patch(buildenv.orig_srcdir, 'src', patch_file, join(builddir, PATCH_INDEX))
 		if os.path.getsize(patch_file) == 0:
 			os.unlink(patch_file)
 	elif os.path.exists(patch_file):
@@ -225,12 +418,18 @@ def do_build_internal(options, args):
 	os.chdir(builddir)
 	print("cd", builddir)
 
+	trace.phase('prepare-env')
 	setup = CompileSetup(iface_cache.stores, sels)
 	setup.prepare_env()
+	if pc_override_stats['hits'] or pc_override_stats['misses']:
+		print("pkg-config override cache: %d hits, %d misses" % (pc_override_stats['hits'], pc_override_stats['misses']))
 
 	# These mappings are needed when mixing Zero Install -dev packages with
 	# native package binaries.
+	trace.phase('lib-mappings')
 	mappings = {}
+	broken_symlinks = find_all_broken_version_symlinks(
+			[impl for impl in sels.selections.values() if not is_package_impl(impl)])
 	for impl in list(sels.selections.values()):
 		# Add mappings that have been set explicitly...
 		new_mappings = impl.attrs.get(XMLNS_0COMPILE + ' lib-mappings', '')
@@ -247,11 +446,7 @@ def do_build_internal(options, args):
 		# Auto-detect required mappings where possible...
 		# (if the -dev package is native, the symlinks will be OK)
 		if not is_package_impl(impl):
-			impl_path = lookup(impl)
-			for libdirname in ['lib', 'usr/lib', 'lib64', 'usr/lib64']:
-				libdir = os.path.join(impl_path, libdirname)
-				if os.path.isdir(libdir):
-					find_broken_version_symlinks(libdir, mappings)
+			mappings.update(broken_symlinks[impl.id])
 
 	if mappings:
 		set_up_mappings(mappings)
@@ -265,13 +460,28 @@ def do_build_internal(options, args):
 	# Make a copy of the source if needed.
 	dup_src_type = src_impl.attrs.get(XMLNS_0COMPILE + ' dup-src', None)
 	if dup_src_type == 'true':
+		trace.phase('dup-src')
 		dup_src(copy_file)
 		env('SRCDIR', builddir)
 	elif dup_src_type:
 		raise Exception("Unknown dup-src value '%s'" % dup_src_type)
 
+	if options.jobs:
+		set_jobs(parse_jobs(options.jobs))
+
+	if options.compiler_cache:
+		compiler_cache = set_up_compiler_cache(sels)
+		cache_stats_before = compiler_cache.get_stats()
+	else:
+		compiler_cache = None
+
+	# (the build command mustn't see our internal settings; e.g. a 0compile it runs would use them too)
+	build_env = dict((name, value) for name, value in os.environ.items()
+			if name not in (BUILDDIR_ENV, STAGING_DISTDIR_ENV, SELECTIONS_ENV))
+
+	trace.phase('build-command')
 	if options.shell:
-		spawn_and_check(find_in_path('cmd' if os.name == 'nt' else 'sh'), [])
+		spawn_and_check(find_in_path('cmd' if os.name == 'nt' else 'sh'), [], env = build_env)
 	else:
 		command = sels.commands[0].qdom.attrs.get('shell-command', None)
 		if command is None:
@@ -285,13 +495,16 @@ def do_build_internal(options, args):
 				prog_args = ['/bin/sh', '-c', command + ' "$@"', '-'] + args
 			assert len(sels.commands) == 1
 
+		log_ext = LOG_COMPRESSION[options.log_compression] if options.log_compression else ''
+
 		# Remove any existing log files
 		for log in ['build.log', 'build-success.log', 'build-failure.log']:
-			if os.path.exists(log):
-				os.unlink(log)
+			for ext in [''] + list(LOG_COMPRESSION.values()):
+				if os.path.exists(log + ext):
+					os.unlink(log + ext)
 
 		# Run the command, copying output to a new log
-		with open('build.log', 'w') as log:
+		with open_build_log('build.log' + log_ext, 'w') as log:
 			print("Build log for %s-%s" % (master_feed.get_name(),
 							      src_impl.version), file=log)
 			print("\nBuilt using 0compile-%s" % __main__.version, file=log)
@@ -304,8 +517,11 @@ def do_build_internal(options, args):
 
 			if os.path.exists(patch_file):
 				print("\nPatched with:\n", file=log)
-				with open(patch_file, 'r') as src:
-					shutil.copyfileobj(src, log)
+				with open(patch_file, 'r', encoding = 'utf-8', errors = 'replace') as src:
+					patch = src.read(PATCH_LOG_LIMIT)
+					log.write(patch)
+					if src.read(1):
+						print("\n[patch truncated after %d characters; see %s for the full patch]" % (len(patch), patch_file), file=log)
 				log.write('\n')
 
 			if command:
@@ -316,20 +532,26 @@ def do_build_internal(options, args):
 				print("Executing: " + str(prog_args), file=log)
 
 			# Tee the output to the console and to the log
-			child = subprocess.Popen(prog_args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT)
-			while True:
-				data = os.read(child.stdout.fileno(), 100)
-				if not data: break
-				data = data.decode()
-				sys.stdout.write(data)
-				log.write(data)
-			status = child.wait()
+			with trace.subprocess(prog_args):
+				child = subprocess.Popen(prog_args, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, env = build_env)
+				tee_output(child.stdout, log)
+				child.stdout.close()
+				status, rusage = wait_with_rusage(child)
+			if compiler_cache:
+				stats = compiler_cache.get_stats()
+				print("Compiler cache: %s" % ', '.join('%d %s' % (stats[x] - cache_stats_before[x], x)
+						for x in ['hits', 'misses', 'uncacheable']), file=log)
+			if rusage:
+				usage = get_resource_usage(rusage)
+				print("Resource usage: " + ', '.join('%s=%s' % x for x in usage), file=log)
+				for name, value in usage:
+					info.setAttributeNS(None, name, value)
+				save_build_env_xml()
 			failure = None
 			if status == 0:
 				print("Build successful", file=log)
-				shorten_dynamic_library_install_names()
-				fixup_generated_pkgconfig_files()
-				remove_la_files()
+				trace.phase('post-build-fixups')
+				run_post_build_fixups(os.environ['DISTDIR'])
 			elif status > 0:
 				failure = "Build failed with exit code %d" % status
 			else:
@@ -338,27 +560,51 @@ def do_build_internal(options, args):
 				print(failure, file=log)
 
 		if failure:
-			os.rename('build.log', 'build-failure.log')
+			os.rename('build.log' + log_ext, 'build-failure.log' + log_ext)
 			raise SafeException("Command '%s': %s" % (prog_args, failure))
 		else:
-			os.rename('build.log', 'build-success.log')
+			os.rename('build.log' + log_ext, 'build-success.log' + log_ext)
 
 def do_build(args):
-	"""build [ --no-sandbox ] [ --shell | --force | --clean ]"""
-	buildenv = BuildEnv()
-	sels = buildenv.get_selections()
-
+	"""build [ --no-sandbox ] [ --shell | --force | --clean ] [ --log-compression=gzip|xz ] [ --trace ] [ --jobs=N|auto ] [ --compiler-cache ] [ --ram-build ]"""
 	parser = OptionParser(usage="usage: %prog build [options]")
 
 	parser.add_option('', "--no-sandbox", help="disable use of sandboxing", action='store_true')
 	parser.add_option("-s", "--shell", help="run a shell instead of building", action='store_true')
 	parser.add_option("-c", "--clean", help="remove the build directories", action='store_true')
 	parser.add_option("-f", "--force", help="build even if dependencies have changed", action='store_true')
+	parser.add_option('', "--log-compression", help="compress the saved build log", choices = sorted(LOG_COMPRESSION), metavar='gzip|xz')
+	parser.add_option("-j", "--jobs", help="number of parallel jobs for make, ninja, etc ('auto' to use all available CPUs)", metavar='N|auto')
+	parser.add_option('', "--compiler-cache", help="reuse compiler output from previous builds", action='store_true')
+	parser.add_option('', "--ram-build", help="build in memory (%s), copying only the result to disk" % RAM_BUILD_FS, action='store_true')
+	parser.add_option('', "--ram-build-size", help="memory needed for --ram-build (default 2048)", type='int', default=2048, metavar='MB')
+	parser.add_option('', "--trace", help="record the time taken by each phase in the metadir", action='store_true')
 
 	parser.disable_interspersed_args()
 
 	(options, args2) = parser.parse_args(args)
 
+	if options.trace:
+		trace.enable()
+	if options.jobs:
+		parse_jobs(options.jobs)		# (check it's valid now)
+	if options.compiler_cache and os.name == 'nt':
+		raise SafeException("--compiler-cache is not supported on Windows")
+
+	spawn_time = os.environ.pop(SPAWN_TIME_ENV, None)
+	if options.no_sandbox and spawn_time:
+		# We're the build-internal process; include the time taken to start the sandbox
+		startup_start = float(spawn_time)
+	else:
+		startup_start = __main__.start_time
+	info("Start-up of process %d took %.2f s" % (os.getpid(), time.time() - startup_start))
+	trace.startup(startup_start)
+
+	trace.phase('solve')
+	buildenv = BuildEnv()
+	sels = buildenv.get_selections()
+	trace.end_phase()
+
 	builddir = os.path.realpath('build')
 
 	changes = buildenv.get_build_changes()
@@ -371,33 +617,228 @@ def do_build(args):
 		if not options.no_sandbox:
 			print("Build dependencies have changed:\n" + '\n'.join(changes))
 
+	fingerprint_file = join(builddir, FINGERPRINT_FILE)
+	if options.shell or spawn_time:
+		# (the build-internal process leaves the fingerprint to its parent, which
+		# saves it only once the whole build, including any sync-out, has succeeded)
+		fingerprint = None
+	else:
+		trace.phase('fingerprint')
+		fingerprint = get_build_fingerprint(buildenv, sels, options, args2)
+		trace.end_phase()
+		if not (options.force or options.clean) and is_up_to_date(buildenv, fingerprint_file, fingerprint):
+			print("Nothing to do: the sources, dependencies and %s haven't changed since the last successful build." % ENV_FILE)
+			print("To build anyway, use: 0compile build --force")
+			return
+
+	build_start = time.time()
 	ensure_dir(builddir, options.clean)
 	ensure_dir(buildenv.distdir, options.clean)
 
-	if options.no_sandbox:
-		return do_build_internal(options, args2)
-
-	tmpdir = tempfile.mkdtemp(prefix = '0compile-')
-	try:
-		my_dir = os.path.dirname(__file__)
-		readable = ['.', my_dir]
-		writable = ['build', buildenv.distdir, tmpdir]
-		env('TMPDIR', tmpdir)
+	if os.path.exists(fingerprint_file):
+		os.unlink(fingerprint_file)
 
-		for selection in list(sels.selections.values()):
-			if not is_package_impl(selection):
-				readable.append(lookup(selection))
+	trace_file = join(buildenv.metadir, TRACE_FILE)
 
-		options = []
-		if __main__.options.verbose:
-			options.append('--verbose')
+	# (if we're the build-internal process of a --ram-build, our parent has already set this up)
+	if options.ram_build and BUILDDIR_ENV not in os.environ:
+		ram_build = RamBuild.create(options.ram_build_size, options.clean)
+	else:
+		ram_build = None
+
+	if ram_build:
+		final_distdir = buildenv.distdir
+		tmpdir = tempfile.mkdtemp(prefix = '0compile-', dir = ram_build.root)
+		ram_build.start()
+	elif options.no_sandbox:
+		tmpdir = None
+	else:
+		tmpdir = tempfile.mkdtemp(prefix = '0compile-')
 
-		readable.append('/etc')	# /etc/ld.*
+	try:
+		if tmpdir:
+			env('TMPDIR', tmpdir)
 
-		spawn_and_check_maybe_sandboxed(readable, writable, tmpdir, sys.executable, ['-u', sys.argv[0]] + options + ['build', '--no-sandbox'] + args)
+		if options.no_sandbox:
+			try:
+				do_build_internal(options, args2)
+			finally:
+				if ram_build:
+					ram_build.finish(builddir)
+		else:
+			my_dir = os.path.dirname(__file__)
+			readable = ['.', my_dir]
+			writable = ['build', buildenv.distdir, tmpdir,
+				basedir.save_cache_path('0install.net', '0compile')]
+			if ram_build:
+				writable.append(ram_build.root)
+
+			for selection in list(sels.selections.values()):
+				if not is_package_impl(selection):
+					readable.append(lookup(selection))
+
+			options = []
+			if __main__.options.verbose:
+				options.append('--verbose')
+
+			readable.append('/etc')	# /etc/ld.*
+
+			# Save the child from solving again
+			sels_file = join(tmpdir, 'selections.xml')
+			with open(sels_file, 'w') as stream:
+				sels.toDOM().writexml(stream)
+			os.environ[SELECTIONS_ENV] = sels_file
+
+			child_args = ['-u', sys.argv[0]] + options + ['build', '--no-sandbox'] + args
+			try:
+				os.environ[SPAWN_TIME_ENV] = repr(time.time())
+				with trace.subprocess([sys.executable] + child_args):
+					spawn_and_check_maybe_sandboxed(readable, writable, tmpdir, sys.executable, child_args)
+			finally:
+				del os.environ[SELECTIONS_ENV]
+				os.environ.pop(SPAWN_TIME_ENV, None)
+				if ram_build:
+					ram_build.finish(builddir)
+
+		if ram_build:
+			trace.phase('sync-out')
+			ram_build.sync_out(final_distdir)
+			trace.end_phase()
+
+		if fingerprint:
+			save_fingerprint(fingerprint_file, fingerprint)
+
+			# (this records the whole build, including starting the sandbox)
+			if DURATION_RECORDED_ENV not in os.environ:
+				BuildDurations().record(buildenv.interface, sels.selections[buildenv.interface].version,
+						time.time() - build_start)
 	finally:
-		info("Deleting temporary directory '%s'" % tmpdir)
-		shutil.rmtree(tmpdir)
+		trace.save(trace_file)
+		if tmpdir:
+			info("Deleting temporary directory '%s'" % tmpdir)
+			shutil.rmtree(tmpdir)
+
+class RamBuild:
+	"""For 'build --ram-build': the build directory, $TMPDIR and a staging $DISTDIR are kept on a
+	memory-backed filesystem, and only the finished $DISTDIR is copied to disk. The build directory
+	is kept between builds (in a directory specific to this user and work directory)."""
+
+	def __init__(self, root):
+		self.root = root
+		self.builddir = join(root, 'build')
+		self.distdir = join(root, 'distdir')
+
+	@staticmethod
+	def create(size_mb, clean):
+		"""Returns a new RamBuild, or None if there isn't a memory-backed filesystem with size_mb free."""
+		if not (os.path.isdir(RAM_BUILD_FS) and os.access(RAM_BUILD_FS, os.W_OK)):
+			print("No writable %s; building on disk instead" % RAM_BUILD_FS)
+			return None
+		st = os.statvfs(RAM_BUILD_FS)
+		free_mb = st.f_bavail * st.f_frsize // (1024 * 1024)
+		if free_mb < size_mb:
+			print("Only %d MB free in %s (need %d MB); building on disk instead" % (free_mb, RAM_BUILD_FS, size_mb))
+			return None
+
+		root = get_ram_build_root()
+		ensure_dir(root)
+		if os.lstat(root).st_uid != os.getuid():
+			raise SafeException("'%s' is not owned by us!" % root)
+		os.chmod(root, 0o700)
+
+		ram_build = RamBuild(root)
+		ensure_dir(ram_build.builddir, clean)
+		if os.path.exists(ram_build.distdir):
+			shutil.rmtree(ram_build.distdir)
+		os.mkdir(ram_build.distdir)
+		print("Building in %s" % root)
+		return ram_build
+
+	def start(self):
+		env(BUILDDIR_ENV, self.builddir)
+		env(STAGING_DISTDIR_ENV, self.distdir)
+
+	def finish(self, disk_builddir):
+		"""Copy the build logs back to the on-disk build directory."""
+		del os.environ[BUILDDIR_ENV]
+		del os.environ[STAGING_DISTDIR_ENV]
+		for name in os.listdir(disk_builddir):
+			if name.startswith('build') and '.log' in name:
+				os.unlink(join(disk_builddir, name))
+		for name in os.listdir(self.builddir):
+			if name.startswith('build') and '.log' in name:
+				shutil.copy2(join(self.builddir, name), join(disk_builddir, name))
+
+	def sync_out(self, distdir):
+		"""Replace distdir with the new build, which is copied in under a temporary name first."""
+		parent, leaf = os.path.split(distdir)
+		new_distdir = join(parent, '.new-' + leaf)
+		old_distdir = join(parent, '.old-' + leaf)
+		for d in [new_distdir, old_distdir]:
+			if os.path.exists(d):
+				shutil.rmtree(d)
+		print("Copying %s to %s" % (self.distdir, distdir))
+		copy_tree(self.distdir, new_distdir)
+		if os.path.exists(distdir):
+			os.rename(distdir, old_distdir)
+		os.rename(new_distdir, distdir)
+		if os.path.exists(old_distdir):
+			shutil.rmtree(old_distdir)
+		shutil.rmtree(self.distdir)
+
+def get_build_fingerprint(buildenv, sels, options, args):
+	"""A digest of everything that affects the build's result: this version of 0compile,
+	the configuration, the build options and arguments, the selected implementations and
+	the metadata of every file in the source and in any local dependencies (unless they're
+	immutable stored implementations)."""
+	fingerprint = hashlib.sha256()
+	def add(*data):
+		fingerprint.update(('\0'.join(str(x) for x in data) + '\n').encode('utf-8', 'surrogateescape'))
+
+	# (don't include our own outputs if they're inside the source)
+	skip = set([os.path.realpath('build'), buildenv.distdir, os.path.realpath('dependencies')])
+	def add_tree(top):
+		for root, dirs, files in os.walk(top):
+			dirs[:] = sorted(d for d in dirs if os.path.join(root, d) not in skip)
+			for name in sorted(files + dirs):
+				try:
+					st = os.lstat(os.path.join(root, name))
+				except OSError:
+					continue
+				add('file', os.path.join(root, name), st.st_size, st.st_mtime_ns, st.st_mode)
+
+	add('0compile', __main__.version)
+	with open(ENV_FILE, 'rb') as stream:
+		fingerprint.update(stream.read())
+	add('options', options.log_compression, options.jobs and parse_jobs(options.jobs),
+			options.compiler_cache, options.ram_build)
+	add('args', *args)
+
+	for iface, sel in sorted(sels.selections.items()):
+		add('selection', iface, sel.id, sel.version, sel.local_path, *sorted(sel.digests))
+		if sel.local_path is not None and iface != buildenv.interface:
+			# (a local dependency may have changed without its ID changing)
+			add_tree(os.path.realpath(sel.local_path))
+
+	if buildenv.user_srcdir or buildenv.root_impl.local_path is not None:
+		add_tree(buildenv.user_srcdir or buildenv.orig_srcdir)
+
+	return fingerprint.hexdigest()
+
+def is_up_to_date(buildenv, fingerprint_file, fingerprint):
+	"""Check that the last build succeeded, that its output is still there, and that it had this fingerprint."""
+	if not os.path.exists(fingerprint_file):
+		return False
+	if not find_build_log(join('build', 'build-success.log')):
+		return False
+	if not os.path.exists(buildenv.local_iface_file):
+		return False
+	with open(fingerprint_file) as stream:
+		return stream.read().strip() == fingerprint
+
+def save_fingerprint(fingerprint_file, fingerprint):
+	with open(fingerprint_file, 'w') as stream:
+		stream.write(fingerprint + '\n')
 
 def find_feed_for(master_feed):
 	"""Determine the <feed-for> interface for the new binary's feed.
@@ -580,6 +1021,134 @@ def find_broken_version_symlinks(libdir, mappings):
 					print("Broken link %s -> %s; will relocate..." % (x, target))
 					mappings[x[len(prefix):-len(extension)]] = target
 
+def _mtime(path):
+	try:
+		return os.stat(path).st_mtime_ns
+	except OSError:
+		return None
+
+class LibraryIndex:
+	"""Finds libraries by file name in a list of library directories (followed by those
+	in /etc/ld.so.conf). The parsed ld.so.conf and the directory listings are cached in
+	LIBDIR_INDEX_CACHE and reused until the mtimes of the files and directories change."""
+
+	def __init__(self, libdirs):
+		self.changed = False
+		self.cache = load_json_cache(LIBDIR_INDEX_CACHE, {'ldconf': None, 'dirs': {}})
+
+		self.libdirs = libdirs + self.get_ldconf_libdirs()
+
+		# Earlier directories take priority
+		self.index = {}
+		for d in reversed(self.libdirs):
+			for name in self.list_dir(d):
+				self.index[name] = os.path.join(d, name)
+
+	def get_ldconf_libdirs(self):
+		ldconf = self.cache['ldconf']
+		if ldconf and all(_mtime(path) == mtime for path, mtime in ldconf['deps'].items()):
+			return ldconf['libdirs']
+
+		libdirs = []
+		deps = {}
+		def add_ldconf(config_file):
+			deps[config_file] = _mtime(config_file)
+			if not os.path.isfile(config_file):
+				return
+			with open(config_file) as stream:
+				for line in stream:
+					d = line.strip()
+					if d.startswith('include '):
+						glob_pattern = d.split(' ', 1)[1]
+						# (a new file in this directory may match the pattern)
+						pattern_dir = os.path.dirname(glob_pattern) or os.curdir
+						deps[pattern_dir] = _mtime(pattern_dir)
+						for conf in glob.glob(glob_pattern):
+							add_ldconf(conf)
+					elif d and not d.startswith('#'):
+						libdirs.append(d)
+		add_ldconf('/etc/ld.so.conf')
+
+		self.cache['ldconf'] = {'deps': deps, 'libdirs': libdirs}
+		self.changed = True
+		return libdirs
+
+	def list_dir(self, d):
+		mtime = _mtime(d)
+		cached = self.cache['dirs'].get(d, None)
+		if cached and cached[0] == mtime:
+			return cached[1]
+		try:
+			names = os.listdir(d)
+		except OSError:
+			names = []
+		self.cache['dirs'][d] = [mtime, names]
+		self.changed = True
+		return names
+
+	def find(self, wanted):
+		path = self.index.get(wanted, None)
+		if path is not None and os.path.exists(path):
+			return path
+		# (not in the index, or a broken symlink)
+		for d in self.libdirs:
+			path = os.path.join(d, wanted)
+			if os.path.exists(path):
+				return path
+		return None
+
+	def save(self):
+		# Keep only the directories this build searched (the others are mostly in the
+		# implementations used by earlier builds), so that the cache doesn't keep growing
+		for d in list(self.cache['dirs']):
+			if d not in self.libdirs:
+				del self.cache['dirs'][d]
+				self.changed = True
+		if self.changed:
+			save_json_cache(LIBDIR_INDEX_CACHE, self.cache)
+
+def scan_for_broken_version_symlinks(impl_path):
+	"""Run find_broken_version_symlinks on each of impl_path's library directories."""
+	found = {}
+	for libdirname in ['lib', 'usr/lib', 'lib64', 'usr/lib64']:
+		libdir = os.path.join(impl_path, libdirname)
+		if os.path.isdir(libdir):
+			find_broken_version_symlinks(libdir, found)
+	return found
+
+def find_all_broken_version_symlinks(impls):
+	"""Returns a dict mapping each impl's ID to the mappings for its broken symlinks.
+	Stored implementations never change, so their results are cached by digest in
+	BROKEN_SYMLINKS_CACHE; only local implementations and new digests are scanned
+	(concurrently)."""
+	from concurrent.futures import ThreadPoolExecutor
+
+	cache = load_json_cache(BROKEN_SYMLINKS_CACHE, {})
+	results = {}
+	to_scan = []
+	for impl in impls:
+		impl_path = lookup(impl)
+		digest = None if impl.local_path is not None else os.path.basename(impl_path)
+		if digest in cache:
+			extension = '.dylib' if sys.platform == 'darwin' else '.so'
+			for x, target in cache[digest].items():
+				info("Broken link lib%s%s -> %s (cached); will relocate...", x, extension, target)
+			results[impl.id] = cache[digest]
+		else:
+			to_scan.append((impl, impl_path, digest))
+
+	if to_scan:
+		with ThreadPoolExecutor() as pool:
+			scans = pool.map(scan_for_broken_version_symlinks, [impl_path for impl, impl_path, digest in to_scan])
+			for (impl, impl_path, digest), found in zip(to_scan, scans):
+				results[impl.id] = found
+				if digest is not None:
+					cache[digest] = found
+		if any(digest is not None for impl, impl_path, digest in to_scan):
+			save_json_cache(BROKEN_SYMLINKS_CACHE, cache)
+
+	return results
+
 def set_up_mappings(mappings):
 	"""Create a temporary directory with symlinks for each of the library mappings."""
 	libdirs = []
@@ -591,29 +1160,15 @@ def set_up_mappings(mappings):
 		if d: libdirs.append(d)
 	libdirs += ['/lib', '/usr/lib']
 
-	def add_ldconf(config_file):
-		if not os.path.isfile(config_file):
-			return
-		with open(config_file) as stream:
-			for line in stream:
-				d = line.strip()
-				if d.startswith('include '):
-					glob_pattern = d.split(' ', 1)[1]
-					for conf in glob.glob(glob_pattern):
-						add_ldconf(conf)
-				elif d and not d.startswith('#'):
-					libdirs.append(d)
-	add_ldconf('/etc/ld.so.conf')
+	library_index = LibraryIndex(libdirs)
 
 	def find_library(name, wanted):
 		# Takes a short-name and target name of a library and returns
 		# the full path of the library.
-		for d in libdirs:
-			path = os.path.join(d, wanted)
-			if os.path.exists(path):
-				return path
-		print("WARNING: library '%s' not found (searched '%s')!" % (wanted, libdirs))
-		return None
+		path = library_index.find(wanted)
+		if path is None:
+			print("WARNING: library '%s' not found (searched '%s')!" % (wanted, library_index.libdirs))
+		return path
 
 	mappings_dir = os.path.join(os.environ['TMPDIR'], 'lib-mappings')
 	os.mkdir(mappings_dir)
@@ -632,41 +1187,267 @@ def set_up_mappings(mappings):
 			print("Adding mapping lib%s%s -> %s" % (name, soext, target))
 			os.symlink(target, os.path.join(mappings_dir, 'lib' + name + soext))
 
-def copy_file(src, target):
-	if os.path.islink(src):
-		os.symlink(os.readlink(src), target)
-	else:
-		shutil.copy2(src, target)
+	library_index.save()
+
+# dup-src records what it copied here (in $BUILDDIR), so that rebuilds only copy changed files
+DUP_SRC_INDEX = '.0compile-dup-src.json'
+
+def _stat_key(st):
+	return [st.st_size, st.st_mtime_ns, st.st_mode]
 
 def dup_src(fn):
+	"""Copy $SRCDIR into the current directory ($BUILDDIR), using fn(src, target) to copy each file.
+	Files which haven't changed (in either directory) since the last dup_src are skipped, and files
+	and directories which have been removed from $SRCDIR since then are removed from the copy."""
+	from concurrent.futures import ThreadPoolExecutor
+
 	srcdir = os.path.join(os.environ['SRCDIR'], '')
 	builddir = os.environ['BUILDDIR']
 
 	build_in_src = srcdir + 'build' == builddir
 
-	for root, dirs, files in os.walk(srcdir):
-		assert root.startswith(srcdir)
-		reldir = root[len(srcdir):]
-
-		if '.git' in dirs:
-			print("dup-src: skipping %s" % (os.path.join(reldir, '.git')))
-			dirs.remove('.git')
-
-		if (reldir == 'build' and build_in_src) or \
-				('0compile.properties' in files and not build_in_src and reldir != ""):
-			print("dup-src: skipping", reldir)
-			dirs[:] = []
-			continue
-
-		for f in files:
-			target = os.path.join(reldir, f)
-			#print "Copy %s -> %s" % (os.path.join(root, f), target)
-			if os.path.exists(target):
-				os.unlink(target)
-			fn(os.path.join(root, f), target)
-		for d in dirs:
-			target = os.path.join(reldir, d)
-			if not os.path.isdir(target):
-				os.mkdir(target)
+	try:
+		with open(DUP_SRC_INDEX) as stream:
+			old_index = json.load(stream)
+		if old_index.get('srcdir') != srcdir:
+			old_index = {}
+	except (IOError, ValueError):
+		old_index = {}
+	old_files = old_index.get('files', {})
+	old_dirs = old_index.get('dirs', [])
+	new_files = {}
+	new_dirs = []
+
+	def copy(src, target, src_key):
+		if os.path.isdir(target) and not os.path.islink(target):
+			shutil.rmtree(target)		# (was a directory in the source last time)
+		elif os.path.lexists(target):
+			os.unlink(target)
+		fn(src, target)
+		new_files[target] = [src_key, _stat_key(os.lstat(target))]
+
+	unchanged = 0
+	with ThreadPoolExecutor() as pool:
+		jobs = []
+		for root, dirs, files in os.walk(srcdir):
+			assert root.startswith(srcdir)
+			reldir = root[len(srcdir):]
+
+			if '.git' in dirs:
+				print("dup-src: skipping %s" % (os.path.join(reldir, '.git')))
+				dirs.remove('.git')
+
+			if (reldir == 'build' and build_in_src) or \
+					('0compile.properties' in files and not build_in_src and reldir != ""):
+				print("dup-src: skipping", reldir)
+				dirs[:] = []
+				continue
+
+			for f in files:
+				target = os.path.join(reldir, f)
+				src = os.path.join(root, f)
+				src_key = _stat_key(os.lstat(src))
+				old = old_files.get(target, None)
+				if old and old[0] == src_key:
+					try:
+						target_key = _stat_key(os.lstat(target))
+					except OSError:
+						target_key = None
+					if old[1] == target_key:
+						# Neither the source nor our copy has changed
+						new_files[target] = old
+						unchanged += 1
+						continue
+				#print "Copy %s -> %s" % (src, target)
+				jobs.append(pool.submit(copy, src, target, src_key))
+			for d in dirs:
+				target = os.path.join(reldir, d)
+				if os.path.islink(target) or (os.path.lexists(target) and not os.path.isdir(target)):
+					os.unlink(target)		# (was a file in the source last time)
+				if not os.path.isdir(target):
+					os.mkdir(target)
+				new_dirs.append(target)
+		for job in jobs:
+			job.result()
+
+	removed = 0
+	new_dir_set = set(new_dirs)
+	for target in old_files:
+		if target not in new_files and target not in new_dir_set and os.path.lexists(target):
+			info("dup-src: removing %s (no longer in source)", target)
+			os.unlink(target)
+			removed += 1
+	for target in sorted(old_dirs, reverse = True):		# (subdirectories first)
+		if target not in new_dir_set and target not in new_files and \
+				os.path.isdir(target) and not os.path.islink(target):
+			info("dup-src: removing directory %s (no longer in source)", target)
+			shutil.rmtree(target)
+			removed += 1
+
+	with open(DUP_SRC_INDEX, 'w') as stream:
+		json.dump({'srcdir': srcdir, 'files': new_files, 'dirs': new_dirs}, stream)
+
+	print("dup-src: copied %d files (%d unchanged, %d removed)" % (len(jobs), unchanged, removed))
+
+def _list_files(top):
+	"""Map relative path to stat key for each file under top."""
+	files = {}
+	top = os.path.join(top, '')
+	for root, dirs, names in os.walk(top, followlinks = True):
+		reldir = root[len(top):]
+		for f in names:
+			path = os.path.join(root, f)
+			try:
+				st = os.stat(path)
+			except OSError:
+				st = os.lstat(path)	# Broken symlink
+			files[os.path.join(reldir, f)] = [st.st_size, st.st_mtime_ns, st.st_mode]
+	return files
+
+def _run_diff(args):
+	"""Run diff with args. Returns its output (decoded losslessly, or None if diff can't be run)
+	and whether it succeeded. Errors (e.g. a dangling symlink or a FIFO in the source) aren't
+	fatal: diff still reports the differences it could find."""
+	with trace.subprocess(["diff"] + args):
+		try:
+			child = subprocess.Popen(["diff"] + args, stdout = subprocess.PIPE)
+		except OSError as ex:
+			print("WARNING: Failed to run 'diff': ", ex, file=sys.stderr)
+			return None, False
+		# (the error, if any, will already be shown on stderr)
+		output, unused = child.communicate()
+	ok = child.returncode in (0, 1)
+	if not ok:
+		print("WARNING: 'diff %s' failed (exit status %d); the patch may be incomplete" % (' '.join(args), child.returncode), file=sys.stderr)
+	return output.decode('utf-8', 'surrogateescape'), ok
+
+_diff_escapes = {'a': '\a', 'b': '\b', 'f': '\f', 'n': '\n', 'r': '\r', 't': '\t', 'v': '\v'}
+
+def _unquote_diff_name(name):
+	"""Undo GNU diff's quoting of file names containing spaces or special characters
+	(e.g. "src/a b.c" or "src/caf\\303\\251.c"). Unquoted names are returned unchanged."""
+	if not name.startswith('"'):
+		return name
+	data = bytearray()
+	i = 1
+	while i < len(name) and name[i] != '"':
+		c = name[i]
+		if c == '\\' and i + 1 < len(name):
+			c = name[i + 1]
+			if c in '01234567':
+				data.append(int(name[i + 1:i + 4], 8) & 0xff)
+				i += 4
+				continue
+			c = _diff_escapes.get(c, c)
+			i += 1
+		data += c.encode('utf-8', 'surrogateescape')
+		i += 1
+	return data.decode('utf-8', 'surrogateescape')
+
+def _split_diff(output, orig_srcdir, user_srcdir):
+	"""Split the output of 'diff -urN orig_srcdir user_srcdir' into a dict of per-file diffs,
+	using the file name on each diff's '+++' line (or the names in a 'Binary files' line).
+	Returns None if some of the output can't be matched to a file."""
+	orig_prefix = os.path.join(orig_srcdir, '')
+	user_prefix = os.path.join(user_srcdir, '')
+
+	chunks = []
+	for line in output.splitlines(True):
+		if line.startswith('diff ') or line.startswith('Binary files ') or not chunks:
+			chunks.append([line])
+		else:
+			chunks[-1].append(line)
+
+	diffs = {}
+	for chunk in chunks:
+		path = None
+		first = chunk[0].rstrip('\n')
+		if first.startswith('Binary files ') and first.endswith(' differ'):
+			# (the names may contain ' and ', so try each split until both name the same file)
+			names = first[len('Binary files '):-len(' differ')]
+			for m in re.finditer(' and ', names):
+				a = _unquote_diff_name(names[:m.start()])
+				b = _unquote_diff_name(names[m.end():])
+				if a.startswith(orig_prefix) and b.startswith(user_prefix) and \
+				   a[len(orig_prefix):] == b[len(user_prefix):]:
+					path = b
+					break
+		else:
+			for line in chunk:
+				if line.startswith('+++ '):
+					name = line[4:].rstrip('\n')
+					if not name.startswith('"'):
+						name = name.split('\t', 1)[0]		# (followed by the timestamp)
+					path = _unquote_diff_name(name)
+					break
+		if path is None or not path.startswith(user_prefix):
+			warn("Unexpected output from diff: %s", first)
+			return None
+		rel = path[len(user_prefix):]
+		diffs[rel] = diffs.get(rel, '') + ''.join(chunk)
+	return diffs
+
+def update_patch(orig_srcdir, user_srcdir, patch_file, index_file):
+	"""Write the differences between orig_srcdir and user_srcdir to patch_file, in the
+	format of 'diff -urN'. The diff of each file is cached in index_file along with the
+	files' stat information, so that only files that have changed are diffed again."""
+
+	try:
+		with open(index_file) as stream:
+			index = json.load(stream)
+		if index.get('dirs') != [orig_srcdir, user_srcdir]:
+			index = {}
+	except (IOError, ValueError):
+		index = {}
+	old_entries = index.get('files', None)
+
+	orig_files = _list_files(orig_srcdir)
+	user_files = _list_files(user_srcdir)
+
+	entries = {}
+	diff_failed = False
+	if old_entries is None:
+		info("No patch index; diffing everything")
+		output, ok = _run_diff(["-urN", orig_srcdir, user_srcdir])
+		diff_failed = not ok
+		diffs = _split_diff(output or '', orig_srcdir, user_srcdir)
+		if diffs is None:
+			info("Can't split the output of diff; diffing each file separately")
+			old_entries = {}
+		else:
+			for rel in set(orig_files) | set(user_files):
+				entries[rel] = [orig_files.get(rel), user_files.get(rel), diffs.get(rel, '')]
+	if old_entries is not None:
+		rediffed = 0
+		for rel in set(orig_files) | set(user_files):
+			keys = [orig_files.get(rel), user_files.get(rel)]
+			old = old_entries.get(rel, None)
+			if old and old[:2] == keys:
+				entries[rel] = old
+				continue
+			orig_path = os.path.join(orig_srcdir, rel)
+			user_path = os.path.join(user_srcdir, rel)
+			output, ok = _run_diff(["-uN", orig_path, user_path])
+			if not ok:
+				diff_failed = True
+			if output is None:
+				output = ''
+			elif output.startswith('--- '):
+				output = 'diff -urN %s %s\n' % (orig_path, user_path) + output
+			entries[rel] = keys + [output]
+			rediffed += 1
+		info("Patch index: diffed %d changed files (%d unchanged)", rediffed, len(entries) - rediffed)
+
+	with open(patch_file, 'w', encoding = 'utf-8', errors = 'surrogateescape') as stream:
+		# (same order as diff -r)
+		for rel in sorted(entries, key = lambda rel: rel.split(os.sep)):
+			stream.write(entries[rel][2])
+
+	if diff_failed:
+		if os.path.exists(index_file):
+			os.unlink(index_file)
+	else:
+		with open(index_file, 'w') as stream:
+			json.dump({'dirs': [orig_srcdir, user_srcdir], 'files': entries}, stream)
 
 __main__.commands.append(do_build)
@@ -0,0 +1,41 @@
+# The "cache" command, which shows the statistics of (or empties) the cache used by 'build --compiler-cache'.
+
+import __main__
+
+from zeroinstall.support import basedir
+
+import compiler_cache
+
+def get_compiler_cache():
+	"""The compiler cache used by 'build --compiler-cache' (shared by all build directories)."""
+	cache_dir = basedir.save_cache_path('0install.net', '0compile', 'compiler-cache')
+	return compiler_cache.CompilerCache(cache_dir, compiler_cache.get_max_size())
+
+def format_size(size):
+	return '%.1f MB' % (size / 1024.0 / 1024)
+
+def do_cache(args):
+	"""cache [ stats | clear ]"""
+	if len(args) > 1:
+		raise __main__.UsageError()
+	action = args[0] if args else 'stats'
+
+	cache = get_compiler_cache()
+	if action == 'stats':
+		stats = cache.get_stats()
+		lookups = stats['hits'] + stats['misses']
+		print("Compiler cache: %s" % cache.cache_dir)
+		print("Hits:          %d" % stats['hits'])
+		print("Misses:        %d" % stats['misses'])
+		if lookups:
+			print("Hit rate:      %.1f%%" % (100.0 * stats['hits'] / lookups))
+		print("Uncacheable:   %d" % stats['uncacheable'])
+		print("Evicted:       %d" % stats['evicted'])
+		print("Size:          %s (maximum %s)" % (format_size(stats['size']), format_size(stats['max-size'])))
+	elif action == 'clear':
+		cache.clear()
+		print("Cleared %s" % cache.cache_dir)
+	else:
+		raise __main__.UsageError()
+
+__main__.commands.append(do_cache)
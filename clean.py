@@ -3,7 +3,7 @@
 
 import __main__, shutil, os
 
-from support import BuildEnv
+from support import BuildEnv, get_ram_build_root
 
 def do_clean(args):
 	"""clean"""
@@ -17,4 +17,10 @@ def do_clean(args):
 			print("Removing '%s'" % os.path.basename(x))
 			shutil.rmtree(x)
 
+	# (left by 'build --ram-build')
+	ram_build_root = get_ram_build_root()
+	if os.path.isdir(ram_build_root):
+		print("Removing '%s'" % ram_build_root)
+		shutil.rmtree(ram_build_root)
+
 __main__.commands.append(do_clean)
@@ -0,0 +1,316 @@
+# A cache of compiler output, used by 'build --compiler-cache'.
+# The build command's $CC and $CXX are set to wrapper scripts which run this file as:
+#
+#   python compiler_cache.py REAL-COMPILER ARGS...
+#
+# Objects are stored by the hash of the preprocessed source, the compiler, its arguments and
+# $ZI_COMPILE_CACHE_KEY (the digest of the build's selections), in $ZI_COMPILE_CACHE_DIR.
+# This file is run for every compile, so it must not import zeroinstall.
+
+import os, sys, json, hashlib, subprocess, shutil, errno
+
+# Change this if the format of the cache changes
+CACHE_VERSION = '1'
+
+# Default maximum size of the cache (can be overridden with $ZI_COMPILE_CACHE_MAX_SIZE, in MB)
+DEFAULT_MAX_SIZE = 5 * 1024 * 1024 * 1024
+
+# When the cache gets too big, evict the least-recently-used objects until it's this fraction of the maximum
+EVICT_TO = 0.9
+
+SOURCE_EXTENSIONS = ('.c', '.cc', '.cpp', '.cxx', '.c++', '.C', '.m', '.mm', '.S')
+
+STATS = ['hits', 'misses', 'uncacheable', 'evicted']
+
+class Uncacheable(Exception):
+	pass
+
+class CompilerCache:
+	def __init__(self, cache_dir, max_size = None):
+		if not os.path.isdir(cache_dir):
+			os.makedirs(cache_dir, exist_ok = True)
+		self.cache_dir = cache_dir
+		self.objects_dir = os.path.join(cache_dir, 'objects')
+		self.stats_file = os.path.join(cache_dir, 'stats.json')
+		if max_size is None:
+			max_size = DEFAULT_MAX_SIZE
+		self.max_size = max_size
+
+	def _locked(self):
+		"""Take an exclusive lock on the cache (several compilers may be running at once)."""
+		stream = open(os.path.join(self.cache_dir, 'lock'), 'a')
+		try:
+			import fcntl
+			fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+		except ImportError:
+			pass	# Windows
+		return stream
+
+	def _read_stats(self):
+		try:
+			with open(self.stats_file) as stream:
+				return json.load(stream)
+		except (IOError, ValueError):
+			return dict((x, 0) for x in STATS + ['size'])
+
+	def get_stats(self):
+		stats = self._read_stats()
+		stats['max-size'] = self.max_size
+		return stats
+
+	def update_stats(self, added_size = 0, **counts):
+		"""Add to the counters (and the total size), evicting old objects if the cache is now too big."""
+		with self._locked():
+			stats = self._read_stats()
+			for name, n in counts.items():
+				stats[name] = stats.get(name, 0) + n
+			stats['size'] = stats.get('size', 0) + added_size
+			if stats['size'] > self.max_size:
+				evicted, stats['size'] = self.evict(int(self.max_size * EVICT_TO))
+				stats['evicted'] = stats.get('evicted', 0) + evicted
+			tmp = self.stats_file + '.new'
+			with open(tmp, 'w') as stream:
+				json.dump(stats, stream)
+			os.rename(tmp, self.stats_file)
+
+	def evict(self, target_size):
+		"""Delete the least-recently-used entries until the cache is no bigger than target_size.
+		Returns the number of entries deleted and the new size.
+		Other compilers may be using the cache while we do this (store and lookup don't take the lock),
+		so files may disappear at any time, and files still being written by store are left alone."""
+		entries = {}
+		for root, dirs, files in os.walk(self.objects_dir):
+			for f in files:
+				if '.tmp-' in f:
+					continue
+				path = os.path.join(root, f)
+				key = f.split('.', 1)[0]
+				try:
+					st = os.stat(path)
+				except OSError as ex:
+					if ex.errno != errno.ENOENT:
+						raise
+					continue
+				mtime, size, paths = entries.get(key, (0, 0, []))
+				entries[key] = (max(mtime, st.st_mtime), size + st.st_size, paths + [path])
+		total = sum(size for mtime, size, paths in entries.values())
+		evicted = 0
+		for mtime, size, paths in sorted(entries.values()):
+			if total <= target_size:
+				break
+			for path in paths:
+				try:
+					os.unlink(path)
+				except OSError as ex:
+					if ex.errno != errno.ENOENT:
+						raise
+			total -= size
+			evicted += 1
+		return evicted, total
+
+	def clear(self):
+		with self._locked():
+			if os.path.isdir(self.objects_dir):
+				shutil.rmtree(self.objects_dir)
+			if os.path.exists(self.stats_file):
+				os.unlink(self.stats_file)
+
+	def _entry(self, key, ext):
+		return os.path.join(self.objects_dir, key[:2], key + ext)
+
+	def lookup(self, key, outputs):
+		"""If key is cached, copy the cached files to outputs (a dict mapping extension to path) and
+		return the compiler's saved stderr output. Returns None if it isn't cached."""
+		entries = dict((ext, self._entry(key, ext)) for ext in outputs)
+		if not all(os.path.exists(entry) for entry in entries.values()):
+			return None
+		for ext, path in outputs.items():
+			if os.path.lexists(path):
+				os.unlink(path)
+			shutil.copyfile(entries[ext], path)
+			os.utime(entries[ext], None)		# (for LRU eviction)
+		stderr_entry = self._entry(key, '.stderr')
+		if not os.path.exists(stderr_entry):
+			return b''
+		with open(stderr_entry, 'rb') as stream:
+			return stream.read()
+
+	def store(self, key, outputs, stderr = b''):
+		"""Add the files in outputs (and the compiler's stderr output) to the cache under key.
+		Returns the number of bytes added."""
+		added = 0
+		files = list(outputs.items())
+		if stderr:
+			tmp = self._entry(key, '.stderr') + '.tmp-%d' % os.getpid()
+			if not os.path.isdir(os.path.dirname(tmp)):
+				os.makedirs(os.path.dirname(tmp), exist_ok = True)
+			with open(tmp, 'wb') as stream:
+				stream.write(stderr)
+			files.append(('.stderr', tmp))
+		# (the objects are stored last, so that lookup doesn't find them before the stderr output)
+		for ext, path in reversed(files):
+			entry = self._entry(key, ext)
+			if not os.path.isdir(os.path.dirname(entry)):
+				os.makedirs(os.path.dirname(entry), exist_ok = True)
+			tmp = '%s.tmp-%d' % (entry, os.getpid())
+			if path != tmp:
+				shutil.copyfile(path, tmp)
+			os.rename(tmp, entry)
+			added += os.path.getsize(entry)
+		return added
+
+def parse_args(args):
+	"""Work out what a compiler command line will do. Returns (source, outputs, args without the
+	source and output paths, preprocessor args), or raises Uncacheable."""
+	if '-c' not in args:
+		raise Uncacheable('not compiling to an object file')
+	source = None
+	output = None
+	dep_file = None
+	deps = False
+	hashed_args = []
+	cpp_args = []
+	i = 0
+	while i < len(args):
+		arg = args[i]
+		if arg in ('-o', '-MF', '-MT', '-MQ'):
+			if i + 1 == len(args):
+				raise Uncacheable('missing argument to ' + arg)
+			value = args[i + 1]
+			if arg == '-o':
+				output = value
+			elif arg == '-MF':
+				dep_file = value
+			else:
+				hashed_args += [arg, value]	# (target name appears in the dependency file)
+			i += 2
+			continue
+		if arg in ('-MD', '-MMD'):
+			deps = True
+			hashed_args.append(arg)
+		elif arg in ('-MP',):
+			hashed_args.append(arg)
+		elif arg in ('-E', '-S', '-M', '-MM', '-', '-save-temps') or arg.startswith('-Wp,') or arg.startswith('@'):
+			raise Uncacheable('unsupported option ' + arg)
+		elif not arg.startswith('-') and arg.endswith(SOURCE_EXTENSIONS):
+			if source is not None:
+				raise Uncacheable('multiple source files')
+			source = arg
+		else:
+			hashed_args.append(arg)
+			if arg != '-c':
+				cpp_args.append(arg)
+		i += 1
+
+	if source is None:
+		raise Uncacheable('no source file')
+	if output is None:
+		output = os.path.splitext(os.path.basename(source))[0] + '.o'
+	outputs = {'.o': output}
+	if deps:
+		outputs['.d'] = dep_file or os.path.splitext(output)[0] + '.d'
+	return source, outputs, hashed_args, cpp_args + ['-E', source]
+
+def compiler_fingerprint(compiler):
+	"""Identify the compiler executable (its real path, size and mtime)."""
+	if not os.path.isabs(compiler):
+		for d in os.environ.get('PATH', '').split(os.pathsep):
+			path = os.path.join(d, compiler)
+			if os.path.isfile(path) and os.access(path, os.X_OK):
+				compiler = path
+				break
+		else:
+			raise Uncacheable("compiler '%s' not found" % compiler)
+	compiler = os.path.realpath(compiler)
+	st = os.stat(compiler)
+	return '%s %d %d' % (compiler, st.st_size, st.st_mtime_ns)
+
+def get_key(compiler, args):
+	"""Returns the cache key for this compilation and the files it will produce."""
+	source, outputs, hashed_args, cpp_args = parse_args(args)
+
+	h = hashlib.sha256()
+	def add(data):
+		if isinstance(data, str):
+			data = data.encode('utf-8', 'surrogateescape')
+		h.update(data)
+		h.update(b'\0')
+	add(CACHE_VERSION)
+	add(compiler_fingerprint(compiler))
+	add(os.environ.get('ZI_COMPILE_CACHE_KEY', ''))
+	add(' '.join(hashed_args))
+	if '.d' in outputs or any(arg.startswith('-g') for arg in hashed_args):
+		# Debug info and dependency files contain the build directory
+		add(os.getcwd())
+	if '.d' in outputs:
+		# ... and dependency files name the object file
+		add(outputs['.o'])
+
+	preprocess = subprocess.Popen([compiler] + cpp_args, stdout = subprocess.PIPE, stderr = subprocess.DEVNULL)
+	for data in iter(lambda: preprocess.stdout.read(64 * 1024), b''):
+		h.update(data)
+	preprocess.stdout.close()
+	if preprocess.wait():
+		raise Uncacheable('preprocessor failed')
+	return h.hexdigest(), outputs
+
+def update_stats(cache, *args, **kwargs):
+	try:
+		cache.update_stats(*args, **kwargs)
+	except (IOError, OSError) as ex:
+		print("compiler_cache: failed to update statistics: %s" % ex, file = sys.stderr)
+
+def write_stderr(data):
+	sys.stderr.flush()
+	sys.stderr.buffer.write(data)
+	sys.stderr.flush()
+
+def compile(cache, compiler, args):
+	"""Run 'compiler args', using the cache if possible. Returns the exit status.
+	Problems with the cache itself are reported, but never stop the compiler from running."""
+	try:
+		key, outputs = get_key(compiler, args)
+	except Uncacheable:
+		update_stats(cache, uncacheable = 1)
+		return subprocess.call([compiler] + args)
+	except (IOError, OSError) as ex:
+		print("compiler_cache: %s" % ex, file = sys.stderr)
+		return subprocess.call([compiler] + args)
+
+	try:
+		stderr = cache.lookup(key, outputs)
+	except (IOError, OSError) as ex:
+		print("compiler_cache: failed to read from cache: %s" % ex, file = sys.stderr)
+		stderr = None
+	if stderr is not None:
+		write_stderr(stderr)
+		update_stats(cache, hits = 1)
+		return 0
+
+	child = subprocess.Popen([compiler] + args, stderr = subprocess.PIPE)
+	unused, stderr = child.communicate()
+	write_stderr(stderr)
+	if child.returncode == 0 and all(os.path.exists(path) for path in outputs.values()):
+		try:
+			added = cache.store(key, outputs, stderr)
+		except (IOError, OSError) as ex:
+			print("compiler_cache: failed to add to cache: %s" % ex, file = sys.stderr)
+			added = 0
+		update_stats(cache, added, misses = 1)
+	else:
+		update_stats(cache, misses = 1)
+	return child.returncode
+
+def get_max_size():
+	max_size = os.environ.get('ZI_COMPILE_CACHE_MAX_SIZE', None)
+	if max_size:
+		return int(max_size) * 1024 * 1024
+	return None
+
+if __name__ == '__main__':
+	try:
+		cache = CompilerCache(os.environ['ZI_COMPILE_CACHE_DIR'], get_max_size())
+	except (IOError, OSError) as ex:
+		print("compiler_cache: %s" % ex, file = sys.stderr)
+		sys.exit(subprocess.call(sys.argv[1:]))
+	sys.exit(compile(cache, sys.argv[1], sys.argv[2:]))
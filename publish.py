@@ -10,8 +10,6 @@ from zeroinstall import SafeException
 
 from support import BuildEnv, spawn_and_check
 
-pubish_command = os.environ["ZI_COMPILE_0PUBLISH"]
-
 def do_publish(args):
 	"""publish [ DOWNLOAD-BASE-URL ]"""
 
@@ -60,7 +58,7 @@ def do_publish(args):
 	# 0compile. This is currently needed for Arch Linux, but long-term we need to
 	# use the <runner>.
 	spawn_and_check(sys.executable, [
-		pubish_command,
+		os.environ["ZI_COMPILE_0PUBLISH"],
 		target_feed,
 		'--archive-url', download_url,
 		'--archive-extract', buildenv.archive_stem])
@@ -1,11 +1,13 @@
 # Copyright (C) 2006, Thomas Leonard
 # See http://0install.net/0compile.html
 
-import os, sys, shutil
+import os, sys, shutil, time, json, math, hashlib, io
 import subprocess
+from contextlib import contextmanager
 from os.path import join
 from logging import info
 import configparser
+from xml.parsers.expat import ExpatError
 
 from zeroinstall.injector import model, selections, qdom, arch
 from zeroinstall.injector.arch import canonicalize_os, canonicalize_machine
@@ -13,7 +15,7 @@ from zeroinstall.injector.arch import canonicalize_os, canonicalize_machine
 from zeroinstall.injector.iface_cache import iface_cache
 from zeroinstall import SafeException
 from zeroinstall.zerostore import Store, NotStored
-from zeroinstall.support import find_in_path
+from zeroinstall.support import find_in_path, basedir
 
 Prefixes = qdom.Prefixes
 
@@ -28,6 +30,9 @@ import platform
 uname = arch._uname + platform.uname()[len(arch._uname):]
 
 ENV_FILE = '0compile.properties'
+
+# Compression formats for the stored build log (build.log, build-success.log, ...)
+LOG_COMPRESSION = {'gzip': '.gz', 'xz': '.xz'}
 XMLNS_0COMPILE = 'http://zero-install.sourceforge.net/2006/namespaces/0compile'
 
 install_path = os.environ.get("ZI_COMPILE_0INSTALL", None)
@@ -46,11 +51,193 @@ if install_path is None:
 else:
 	install_prog = [install_path]
 
+# Set by the --refresh option: solve again (and check for updates), ignoring SELECTIONS_CACHE
+refresh = False
+
+# The result of the last solve, and the inputs to the solver it depended on
+SELECTIONS_CACHE = '.0compile-selections.json'
+
 if os.path.isdir('dependencies'):
 	dep_dir = os.path.realpath('dependencies')
 	iface_cache.stores.stores.append(Store(dep_dir))
 	install_prog.append('--with-store='+ dep_dir)
 
+# Where 'build --ram-build' puts the build directory, $TMPDIR and the staging $DISTDIR
+RAM_BUILD_FS = '/dev/shm'
+
+# 'build --ram-build' tells the build-internal process to use these directories instead of
+# 'build' and the distdir
+BUILDDIR_ENV = 'ZI_COMPILE_BUILDDIR'
+STAGING_DISTDIR_ENV = 'ZI_COMPILE_STAGING_DISTDIR'
+
+# 'build' passes its selections to the build-internal process in this file, and the time it started it
+SELECTIONS_ENV = 'ZI_COMPILE_SELECTIONS'
+SPAWN_TIME_ENV = 'ZI_COMPILE_SPAWN_TIME'
+
+# 'build --trace' writes the timings of each phase here (in the metadir)
+TRACE_FILE = 'build-trace.json'
+
+# Identifies the build being traced, so the parent and the sandboxed child add to the same trace
+TRACE_RUN_ENV = 'ZI_COMPILE_TRACE_RUN'
+
+class BuildTrace:
+	"""Records the wall and CPU time of each phase of a build, and of the helper processes
+	it runs, for 'build --trace'. Does nothing unless enabled."""
+	enabled = False
+
+	def __init__(self):
+		self.spans = []
+		self.current = None
+
+	def enable(self):
+		self.enabled = True
+		self.run = os.environ.get(TRACE_RUN_ENV, None) or '%d-%d' % (os.getpid(), time.time())
+		os.environ[TRACE_RUN_ENV] = self.run
+
+	def _start(self, name, kind, **details):
+		times = os.times()
+		span = {'name': name, 'kind': kind, 'pid': os.getpid(), 'start': time.time()}
+		span.update(details)
+		return span, times
+
+	def _end(self, span_and_times):
+		span, start_times = span_and_times
+		times = os.times()
+		span['wall'] = time.time() - span['start']
+		span['cpu'] = (times.user + times.system) - (start_times.user + start_times.system)
+		span['children_cpu'] = (times.children_user + times.children_system) - \
+				       (start_times.children_user + start_times.children_system)
+		self.spans.append(span)
+
+	def phase(self, name):
+		"""Start timing a new phase, ending the current one (if any)."""
+		if self.enabled:
+			self.end_phase()
+			self.current = self._start(name, 'phase')
+
+	def end_phase(self):
+		if self.current:
+			self._end(self.current)
+			self.current = None
+
+	def startup(self, start):
+		"""Record the time from start until now (e.g. from starting the process to running the command).
+		All of the CPU time used by this process so far is counted."""
+		if self.enabled:
+			times = os.times()
+			self.spans.append({'name': 'startup', 'kind': 'phase', 'pid': os.getpid(), 'start': start,
+				'wall': time.time() - start, 'cpu': times.user + times.system, 'children_cpu': 0})
+
+	@contextmanager
+	def subprocess(self, args):
+		"""Time a helper process (including waiting for it to exit)."""
+		if not self.enabled:
+			yield
+			return
+		span = self._start(os.path.basename(args[0]), 'subprocess', args = [str(a) for a in args])
+		try:
+			yield
+		finally:
+			self._end(span)
+
+	def save(self, path):
+		"""Add our spans to the trace in path (replacing it if it's from a different run)."""
+		if not self.enabled:
+			return
+		self.end_phase()
+		spans = []
+		try:
+			with open(path) as stream:
+				old = json.load(stream)
+			if old.get('run') == self.run:
+				spans = old['spans']
+		except (IOError, ValueError):
+			pass
+		spans = sorted(spans + self.spans, key = lambda span: span['start'])
+		self.spans = []
+		if not os.path.isdir(os.path.dirname(path)):
+			os.makedirs(os.path.dirname(path))
+		with open(path, 'w') as stream:
+			json.dump({'run': self.run, 'spans': spans}, stream, indent = 1)
+
+trace = BuildTrace()
+
+def load_json_cache(name, default):
+	"""Load the cache file name from $XDG_CACHE_HOME/0install.net/0compile, or return default if
+	it doesn't exist or can't be read."""
+	path = os.path.join(basedir.save_cache_path('0install.net', '0compile'), name)
+	try:
+		with open(path) as stream:
+			return json.load(stream)
+	except (IOError, ValueError):
+		return default
+
+def save_json_cache(name, data):
+	"""Atomically replace the cache file name with data. Failure isn't fatal (e.g. inside a sandbox)."""
+	path = os.path.join(basedir.save_cache_path('0install.net', '0compile'), name)
+	try:
+		tmp = path + '.new-%d' % os.getpid()
+		with open(tmp, 'w') as stream:
+			json.dump(data, stream)
+		os.rename(tmp, path)
+	except (IOError, OSError) as ex:
+		info("Failed to save %s: %s", path, ex)
+
+@contextmanager
+def locked_json_cache(name):
+	"""Hold an exclusive lock for reading, updating and saving the cache file name (several builds
+	may be updating it at once). Failure isn't fatal (e.g. inside a sandbox)."""
+	path = os.path.join(basedir.save_cache_path('0install.net', '0compile'), name + '.lock')
+	try:
+		stream = open(path, 'a')
+	except (IOError, OSError) as ex:
+		info("Failed to lock %s: %s", path, ex)
+		yield
+		return
+	with stream:
+		try:
+			import fcntl
+			fcntl.flock(stream.fileno(), fcntl.LOCK_EX)
+		except ImportError:
+			pass	# Windows
+		yield
+
+# How long recent builds took (see BuildDurations)
+BUILD_DURATIONS_CACHE = 'build-durations.json'
+
+# Set by autocompile, which records the duration of the builds it runs itself
+DURATION_RECORDED_ENV = 'ZI_COMPILE_DURATION_RECORDED'
+
+class BuildDurations:
+	"""The times taken by recent builds of each version of each interface on this type of machine
+	(stored in BUILD_DURATIONS_CACHE), for estimating how long a build will take."""
+
+	# Number of builds of each version to remember
+	KEEP = 5
+
+	def __init__(self):
+		self.arch = get_arch_name()
+		self.data = load_json_cache(BUILD_DURATIONS_CACHE, {})
+
+	def record(self, iface_uri, version, seconds):
+		# (load it again first, in case another build has finished since, and hold the
+		# lock until we've saved it so that a build finishing now doesn't lose ours)
+		with locked_json_cache(BUILD_DURATIONS_CACHE):
+			self.data = load_json_cache(BUILD_DURATIONS_CACHE, {})
+			times = self.data.setdefault(iface_uri, {}).setdefault(self.arch, {}).setdefault(version, [])
+			times.append(round(seconds, 2))
+			del times[:-self.KEEP]
+			save_json_cache(BUILD_DURATIONS_CACHE, self.data)
+
+	def estimate(self, iface_uri, version):
+		"""The median time of recent builds of this version (or of any version, if we haven't built
+		this one before), or None if we've never built this interface."""
+		versions = self.data.get(iface_uri, {}).get(self.arch, {})
+		times = versions.get(version, None) or [t for ts in versions.values() for t in ts]
+		if not times:
+			return None
+		return sorted(times)[len(times) // 2]
+
 class NoImpl:
 	id = "none"
 	version = "none"
@@ -84,13 +271,41 @@ def ensure_dir(d, clean = False):
 		raise SafeException("'%s' exists, but is not a directory!" % d)
 	os.mkdir(d)
 
-def spawn_and_check(prog, args):
-	status = os.spawnv(os.P_WAIT, prog, [prog] + args)
+def open_build_log(path, mode = 'r'):
+	"""Open a (possibly compressed) build log in text mode.
+	The compression is chosen from the file's extension."""
+	if path.endswith('.gz'):
+		import gzip
+		return gzip.open(path, mode + 't', encoding = 'utf-8')
+	if path.endswith('.xz'):
+		import lzma
+		return lzma.open(path, mode + 't', encoding = 'utf-8')
+	return open(path, mode, encoding = 'utf-8')
+
+def find_build_log(stem):
+	"""Return the path of the log stem (e.g. 'build/build-failure.log'), with whatever
+	compression extension it was saved with, or None if there isn't one."""
+	for ext in [''] + list(LOG_COMPRESSION.values()):
+		if os.path.exists(stem + ext):
+			return stem + ext
+	return None
+
+def spawn_and_check(prog, args, env = None):
+	if env is None:
+		status = os.spawnv(os.P_WAIT, prog, [prog] + args)
+	else:
+		status = os.spawnve(os.P_WAIT, prog, [prog] + args, env)
 	if status > 0:
 		raise SafeException("Program '%s' failed with exit code %d" % (prog, status))
 	elif status < 0:
 		raise SafeException("Program '%s' failed with signal %d" % (prog, -status))
 
+def get_ram_build_root():
+	"""The directory in RAM_BUILD_FS used by 'build --ram-build' in the current directory."""
+	import getpass
+	key = hashlib.sha256(os.getcwd().encode('utf-8', 'surrogateescape')).hexdigest()[:16]
+	return join(RAM_BUILD_FS, '0compile-%s-%s' % (getpass.getuser(), key))
+
 def spawn_and_check_maybe_sandboxed(readable, writable, tmpdir, prog, args):
 	child = spawn_maybe_sandboxed(readable, writable, tmpdir, prog, args)
 	status = child.wait()
@@ -156,6 +371,129 @@ def get_arch_name():
 		target_machine = 'i486'	# (sensible default)
 	return target_os + '-' + target_machine
 
+def get_cgroup_cpu_quota():
+	"""The CPU quota of our cgroup, as a (possibly fractional) number of CPUs, or None if unlimited."""
+	cgroup_path = '/'
+	try:
+		with open('/proc/self/cgroup') as stream:
+			for line in stream:
+				hierarchy, controllers, path = line.rstrip('\n').split(':', 2)
+				if hierarchy == '0':
+					cgroup_path = path
+	except (IOError, ValueError):
+		pass
+
+	# cgroup v2 (our own cgroup, or the root of the namespace in a container)
+	for cpu_max in [join('/sys/fs/cgroup' + cgroup_path, 'cpu.max'), '/sys/fs/cgroup/cpu.max']:
+		try:
+			with open(cpu_max) as stream:
+				quota, period = stream.read().split()
+		except (IOError, ValueError):
+			continue
+		if quota == 'max':
+			return None
+		return int(quota) / int(period)
+
+	# cgroup v1
+	try:
+		with open('/sys/fs/cgroup/cpu/cpu.cfs_quota_us') as stream:
+			quota = int(stream.read())
+		with open('/sys/fs/cgroup/cpu/cpu.cfs_period_us') as stream:
+			period = int(stream.read())
+	except (IOError, ValueError):
+		return None
+	if quota <= 0:
+		return None
+	return quota / period
+
+def get_cpu_count():
+	"""The number of CPUs we can really use: the ones we're allowed to run on, limited by
+	any cgroup CPU quota (e.g. in a container)."""
+	if hasattr(os, 'sched_getaffinity'):
+		count = len(os.sched_getaffinity(0))
+	else:
+		count = os.cpu_count() or 1
+	quota = get_cgroup_cpu_quota()
+	if quota is not None:
+		count = min(count, max(1, int(math.ceil(quota))))
+	return count
+
+def parse_jobs(jobs):
+	"""Parse a --jobs value ('auto' or a positive number)."""
+	if jobs == 'auto':
+		return get_cpu_count()
+	try:
+		n = int(jobs)
+	except ValueError:
+		n = 0
+	if n < 1:
+		raise SafeException('--jobs must be "auto" or a positive number, not "%s"' % jobs)
+	return n
+
+# Linux ioctl for sharing a file's data blocks with another file (copy-on-write)
+FICLONE = 0x40049409
+
+# Set to False once we discover that the filesystem can't do reflinks
+_reflink_supported = sys.platform.startswith('linux')
+
+def reflink_file(src, target):
+	"""Try to make target a copy-on-write clone of src. Returns False if not supported."""
+	global _reflink_supported
+	if not _reflink_supported:
+		return False
+	import fcntl, errno
+	with open(src, 'rb') as src_stream:
+		with open(target, 'wb') as target_stream:
+			try:
+				fcntl.ioctl(target_stream.fileno(), FICLONE, src_stream.fileno())
+			except (OSError, IOError) as ex:
+				if ex.errno == errno.EXDEV:
+					pass		# (just these two files are on different filesystems)
+				elif ex.errno in (errno.EOPNOTSUPP, errno.ENOTTY, errno.EINVAL, errno.ENOSYS):
+					info("Reflinks not available (%s); copying instead", ex)
+					_reflink_supported = False
+				ok = False
+			else:
+				ok = True
+	if not ok:
+		os.unlink(target)
+		return False
+	shutil.copystat(src, target)
+	return True
+
+def copy_file(src, target):
+	if os.path.islink(src):
+		os.symlink(os.readlink(src), target)
+	elif not reflink_file(src, target):
+		shutil.copy2(src, target)
+
+def copy_tree(src, target):
+	"""Like shutil.copytree(src, target, symlinks = True), but using reflinks where possible
+	and copying several files at once."""
+	from concurrent.futures import ThreadPoolExecutor
+
+	os.mkdir(target)
+	with ThreadPoolExecutor() as pool:
+		jobs = []
+		for root, dirs, files in os.walk(src):
+			target_dir = join(target, os.path.relpath(root, src))
+			for d in dirs:
+				if os.path.islink(join(root, d)):
+					os.symlink(os.readlink(join(root, d)), join(target_dir, d))
+				else:
+					os.mkdir(join(target_dir, d))
+			for f in files:
+				jobs.append(pool.submit(copy_file, join(root, f), join(target_dir, f)))
+		for job in jobs:
+			job.result()
+
+	# (last, in case any directories are read-only)
+	for root, dirs, files in os.walk(src, topdown = False):
+		for d in dirs:
+			if not os.path.islink(join(root, d)):
+				shutil.copystat(join(root, d), join(target, os.path.relpath(root, src), d))
+	shutil.copystat(src, target)
+
 class BuildEnv:
 	def __init__(self, need_config = True):
 		if need_config and not os.path.isfile(ENV_FILE):
@@ -174,6 +512,9 @@ class BuildEnv:
 
 		self._selections = None
 
+		# (don't cache selections if we're not in a work directory, e.g. during 'setup')
+		self.cache_selections = need_config
+
 		return
 
 	@property
@@ -190,6 +531,9 @@ class BuildEnv:
 
 	@property
 	def distdir(self):
+		staging = os.environ.get(STAGING_DISTDIR_ENV, None)
+		if staging:
+			return staging
 		distdir_name = self.config.get('compile', 'distdir')
 		if not distdir_name:
 			arch = self.target_arch.replace('*', 'any')
@@ -274,13 +618,98 @@ class BuildEnv:
 		with open(ENV_FILE, 'w') as stream:
 			self.config.write(stream)
 
+	def _load_solved_selections(self):
+		"""If we're the build-internal process, return the selections our parent already solved
+		(and downloaded) for us, if any."""
+		solved_file = os.environ.get(SELECTIONS_ENV, None)
+		if not solved_file or not os.path.exists(solved_file):
+			return None
+		with open(solved_file, 'rb') as stream:
+			sels = selections.Selections(qdom.parse(stream))
+		if sels.interface != self.interface:
+			return None		# (for some other build)
+		return sels
+
+	def _get_solve_key(self, sels):
+		"""A digest of the solver's inputs. We don't know exactly which feeds and configuration files
+		0install will read, so we use the directories containing them (0install replaces files by
+		renaming, which updates the directory's mtime), plus any local feeds."""
+		from zeroinstall.injector import namespaces
+		from zeroinstall.support import basedir
+
+		key = hashlib.sha256()
+		def add(*data):
+			key.update(('\0'.join(str(x) for x in data) + '\n').encode('utf-8', 'surrogateescape'))
+		add(self.interface, *install_prog)
+		config = io.StringIO()
+		self.config.write(config)
+		add(config.getvalue())
+
+		paths = list(basedir.load_cache_paths(namespaces.config_site, 'interfaces'))
+		for d in basedir.load_config_paths(namespaces.config_site, namespaces.config_prog):
+			paths += [d, join(d, 'global'), join(d, 'interfaces'), join(d, 'feeds')]
+		feeds = set([self.interface] + [sel.feed for sel in sels.selections.values()])
+		paths += sorted(feed for feed in feeds if os.path.isabs(feed))
+		for path in paths:
+			try:
+				st = os.stat(path)
+			except OSError:
+				add(path, 'missing')
+			else:
+				add(path, st.st_size, st.st_mtime_ns)
+		return key.hexdigest()
+
+	def _load_cached_selections(self):
+		"""Return the selections saved by _save_cached_selections, if the solver's inputs haven't changed
+		and all the selected implementations are still available."""
+		if refresh or not self.cache_selections or not os.path.exists(SELECTIONS_CACHE):
+			return None
+		try:
+			with open(SELECTIONS_CACHE) as stream:
+				cached = json.load(stream)
+			sels = selections.Selections(qdom.parse(io.BytesIO(cached['selections'].encode('utf-8'))))
+		except (IOError, ValueError, KeyError, ExpatError) as ex:
+			info("Ignoring corrupted %s: %s" % (SELECTIONS_CACHE, ex))
+			return None
+		if sels.interface != self.interface or cached['key'] != self._get_solve_key(sels):
+			info("Inputs to the solver have changed; ignoring %s" % SELECTIONS_CACHE)
+			return None
+		for sel in sels.selections.values():
+			try:
+				lookup(sel)
+			except (NotStored, SafeException) as ex:
+				info("Cached selection no longer available: %s" % ex)
+				return None
+		info("Using selections from %s (use --refresh to solve again)" % SELECTIONS_CACHE)
+		return sels
+
+	def _save_cached_selections(self):
+		if not self.cache_selections:
+			return
+		data = {'key': self._get_solve_key(self._selections),
+			'selections': self._selections.toDOM().toxml()}
+		try:
+			with open(SELECTIONS_CACHE + '.new', 'w') as stream:
+				json.dump(data, stream)
+			os.rename(SELECTIONS_CACHE + '.new', SELECTIONS_CACHE)
+		except (IOError, OSError) as ex:
+			info("Failed to save %s: %s" % (SELECTIONS_CACHE, ex))
+
 	def get_selections(self, prompt = False):
 		if self._selections:
 			assert not prompt
 			return self._selections
 
 		selections_file = self.config.get('compile', 'selections')
-		if selections_file:
+		if prompt:
+			solved = None
+		elif selections_file:
+			solved = self._load_solved_selections()
+		else:
+			solved = self._load_solved_selections() or self._load_cached_selections()
+		if solved:
+			self._selections = solved
+		elif selections_file:
 			if prompt:
 				raise SafeException("Selections are fixed by %s" % selections_file)
 			with open(selections_file, 'rb') as stream:
@@ -298,18 +727,22 @@ class BuildEnv:
 				h.wait_for_blocker(blocker)
 		else:
 			command = install_prog + ['download', '--source', '--xml']
+			if refresh:
+				command.append('--refresh')
 			if prompt and '--console' not in install_prog:
 				if os.name == 'nt':
 					command[0] += '-win'
 				command.append('--gui')
 			command.append(self.interface)
-			child = subprocess.Popen(command, stdout = subprocess.PIPE)
-			try:
-				self._selections = selections.Selections(qdom.parse(child.stdout))
-			finally:
-				if child.wait():
-					raise SafeException(' '.join(repr(x) for x in command) + " failed (exit code %d)" % child.returncode)
-				child.stdout.close()
+			with trace.subprocess(command):
+				child = subprocess.Popen(command, stdout = subprocess.PIPE)
+				try:
+					self._selections = selections.Selections(qdom.parse(child.stdout))
+				finally:
+					if child.wait():
+						raise SafeException(' '.join(repr(x) for x in command) + " failed (exit code %d)" % child.returncode)
+					child.stdout.close()
+			self._save_cached_selections()
 
 		self.root_impl = self._selections.selections[self.interface]
 
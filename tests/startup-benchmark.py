@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+# Measures the start-up time of each 0compile command: the time taken to import the command's
+# module (and everything it imports), and the total time for a new Python process to do so.
+# (we don't run "0compile COMMAND --help", because some commands act on that instead)
+#
+# Usage: startup-benchmark.py [ -n RUNS ] [ COMMAND ... ]
+
+import os, sys, subprocess, time, ast, re
+from optparse import OptionParser
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+top_dir = os.path.dirname(my_dir)
+compile_bin = os.path.join(top_dir, '0compile')
+
+# Imported in a new process, as the 0compile script would (it provides the 'commands' list
+# in __main__, which each command's module adds to)
+IMPORT_MODULE = """
+import sys, __main__
+sys.path.insert(0, %r)
+__main__.__file__ = %r
+__main__.commands = []
+import %s
+"""
+
+def get_command_modules():
+	"""Read the command_modules table from the 0compile script (without running it)."""
+	with open(compile_bin) as stream:
+		tree = ast.parse(stream.read())
+	for node in tree.body:
+		if isinstance(node, ast.Assign) and [getattr(t, 'id', None) for t in node.targets] == ['command_modules']:
+			return ast.literal_eval(node.value)
+	raise Exception("No command_modules in %s" % compile_bin)
+
+def time_command(name, module):
+	"""Import the command's module once. Returns (wall time, cumulative import time of its module)."""
+	start = time.time()
+	child = subprocess.Popen([sys.executable, '-X', 'importtime', '-c', IMPORT_MODULE % (top_dir, compile_bin, module)],
+			stdout = subprocess.DEVNULL, stderr = subprocess.PIPE, universal_newlines = True)
+	unused, stderr = child.communicate()
+	wall = time.time() - start
+	if child.returncode:
+		raise Exception("Failed to import %s:\n%s" % (module, stderr))
+	import_time = None
+	for line in stderr.split('\n'):
+		m = re.match(r'import time:\s*\d+ \|\s*(\d+) \| (\S+)$', line)
+		if m and m.group(2) == module:
+			import_time = int(m.group(1)) / 1e6
+	return wall, import_time
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+parser = OptionParser(usage = "usage: %prog [ -n RUNS ] [ COMMAND ... ]")
+parser.add_option('-n', '--runs', help = "times to run each command (default 5)", type = 'int', default = 5)
+(options, args) = parser.parse_args()
+
+command_modules = get_command_modules()
+if args:
+	command_modules = [(name, module) for name, module in command_modules if name in args]
+
+print("%-14s %10s %10s" % ("Command", "Import/ms", "Total/ms"))
+for name, module in command_modules:
+	results = [time_command(name, module) for i in range(options.runs)]
+	import_times = [i for w, i in results if i is not None]
+	print("%-14s %10.1f %10.1f" % (name,
+		median(import_times) * 1000 if import_times else float('nan'),
+		median([w for w, i in results]) * 1000))
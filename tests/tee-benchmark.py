@@ -0,0 +1,70 @@
+#!/usr/bin/env python3
+# Measures how fast 'build' can copy a build's output to the console and to its log
+# (build.tee_output), for each kind of log compression.
+#
+# Usage: tee-benchmark.py [ -s MB ] [ -n RUNS ] [ none | gzip | xz ... ]
+
+import os, sys, time, tempfile, shutil, __main__
+from optparse import OptionParser
+
+my_dir = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(my_dir))
+
+# (as the 0compile script would provide; build.py adds its command to this)
+__main__.commands = []
+
+import build
+from support import LOG_COMPRESSION, open_build_log
+
+# A typical line of compiler output (with a few non-ASCII characters)
+LINE = 'gcc -O2 -Wall -c -o obj/module.o src/module.c  # ‘warning’: unused variable été\n'.encode('utf-8')
+
+def median(values):
+	values = sorted(values)
+	return values[len(values) // 2]
+
+def time_tee(input_path, log_path):
+	"""Copy input_path to a new log at log_path (and to /dev/null). Returns (bytes, seconds)."""
+	real_stdout = sys.stdout
+	with open(input_path, 'rb') as stream, open(os.devnull, 'w', encoding = 'utf-8') as devnull:
+		sys.stdout = devnull
+		try:
+			start = time.time()
+			with open_build_log(log_path, 'w') as log:
+				total = build.tee_output(stream, log)
+			elapsed = time.time() - start
+		finally:
+			sys.stdout = real_stdout
+	os.unlink(log_path)
+	return total, elapsed
+
+parser = OptionParser(usage = "usage: %prog [ -s MB ] [ -n RUNS ] [ none | gzip | xz ... ]")
+parser.add_option('-s', '--size', help = "MB of output to copy (default 300)", type = 'int', default = 300)
+parser.add_option('-n', '--runs', help = "times to copy it for each compression (default 3)", type = 'int', default = 3)
+(options, args) = parser.parse_args()
+
+compressions = args or ['none'] + sorted(LOG_COMPRESSION)
+for c in compressions:
+	if c != 'none' and c not in LOG_COMPRESSION:
+		parser.error("Unknown compression '%s'" % c)
+
+tmpdir = tempfile.mkdtemp(prefix = 'tee-benchmark-')
+try:
+	input_path = os.path.join(tmpdir, 'output')
+	with open(input_path, 'wb') as stream:
+		block = LINE * (1024 * 1024 // len(LINE))
+		written = 0
+		while written < options.size * 1024 * 1024:
+			stream.write(block)
+			written += len(block)
+
+	print("%-12s %10s" % ("Compression", "MB/s"))
+	for c in compressions:
+		log_path = os.path.join(tmpdir, 'build.log' + LOG_COMPRESSION.get(c, ''))
+		rates = []
+		for i in range(options.runs):
+			total, elapsed = time_tee(input_path, log_path)
+			rates.append(total / elapsed / 1e6)
+		print("%-12s %10.1f" % (c, median(rates)))
+finally:
+	shutil.rmtree(tmpdir)
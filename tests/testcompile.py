@@ -44,7 +44,7 @@ if subprocess.call(zi_command + ['-c', 'download', '--version=2.0.6', 'http://ro
 	raise Exception("Failed to download ROX-Lib test program")
 
 def compile(*args, **kwargs):
-	run(*([sys.executable, compile_bin] + list(args)), **kwargs)
+	return run(*([sys.executable, compile_bin] + list(args)), **kwargs)
 
 def run(*args, **kwargs):
 	if not isinstance(args[0], str):
@@ -63,6 +63,15 @@ def run(*args, **kwargs):
 				raise Exception("Expected '%s', got '%s'" % (expected, got))
 		elif got:
 			raise Exception("Expected nothing, got '%s'" % got)
+	return got
+
+def import_command_module(name):
+	"""Import one of 0compile's command modules, for testing its functions directly
+	(the module adds its commands to the 0compile script's list, so provide one)."""
+	import __main__
+	if not hasattr(__main__, 'commands'):
+		__main__.commands = []
+	return __import__(name)
 
 # Detect accidental network access
 os.environ['http_proxy'] = 'localhost:1111'
@@ -100,6 +109,8 @@ class TestCompile(unittest.TestCase):
 
 	def testBadCommand(self):
 		compile('foo', expect = 'usage: 0compile', expect_status = 1)
+		compile('foo', expect = '0compile include-deps', expect_status = 1)
+		compile('c', expect = "What do you mean by 'c'?", expect_status = 1)
 		compile('setup', hello_uri, self.tmpdir, expect = 'already exists', expect_status = 1)
 		os.chdir(self.tmpdir)
 		compile('setup', expect = 'Run 0compile from a directory containing', expect_status = 1)
@@ -131,7 +142,10 @@ class TestCompile(unittest.TestCase):
 
 	def testRecursive(self):
 		top = os.path.join(mydir, 'top.xml')
-		compile('autocompile', top, expect = "No dependencies need compiling... compile cprog itself...")
+		got = compile('autocompile', top, expect = "No dependencies need compiling... compile cprog itself...")
+
+		# Once to plan the top and once to plan cprog: building cprog doesn't mean solving for the top again
+		assert 'Selected versions 2 times' in got, got
 
 		# Dependency was registered against its local path, since that was how we depended on it:
 		run(zi_command, "run", os.path.join(mydir, 'cprog/cprog-command.xml'), expect = 'Hello from C')
@@ -141,6 +155,135 @@ class TestCompile(unittest.TestCase):
 		i = c.iface_cache.get_interface('http://example.com/top.xml')
 		self.assertEqual(1, len(i.extra_feeds))
 
+	def testBinaryCache(self):
+		top = os.path.join(mydir, 'top.xml')
+		cache_dir = os.path.join(self.tmpdir, 'binary-cache')
+		compile('autocompile', '--binary-cache', cache_dir, top, expect = "No dependencies need compiling... compile cprog itself...")
+		self.assertEqual(2, len(os.listdir(cache_dir)))
+
+		# Start again with an empty site-packages
+		shutil.rmtree(basedir.save_data_path('0install.net', 'site-packages'))
+		compile('autocompile', '--binary-cache', cache_dir, top, expect = "Using existing build of cprog")
+		run(zi_command, "run", os.path.join(mydir, 'cprog/cprog-command.xml'), expect = 'Hello from C')
+
+	def testPrefetch(self):
+		import tarfile, threading, json, functools
+		from http.server import HTTPServer, SimpleHTTPRequestHandler
+
+		# A source archive, served from localhost (local feeds don't need signing)
+		serve_dir = os.path.join(self.tmpdir, 'serve')
+		src_dir = os.path.join(self.tmpdir, 'prefetch-0.1')
+		os.mkdir(serve_dir)
+		os.mkdir(src_dir)
+		with open(os.path.join(src_dir, 'README'), 'w') as stream:
+			stream.write('Prefetched\n')
+		archive = os.path.join(serve_dir, 'prefetch-0.1.tar.gz')
+		with tarfile.open(archive, 'w:gz') as tar:
+			tar.add(src_dir, 'prefetch-0.1')
+		digest = subprocess.check_output(zi_command + ['digest', archive, 'prefetch-0.1']).decode('utf-8').strip()
+		alg, value = digest.split('=' if '=' in digest else '_', 1)
+
+		requests = []
+		class Handler(SimpleHTTPRequestHandler):
+			def log_message(self, *args):
+				requests.append(self.path)
+		server = HTTPServer(('127.0.0.1', 0), functools.partial(Handler, directory = serve_dir))
+		thread = threading.Thread(target = server.serve_forever)
+		thread.start()
+
+		feed = os.path.join(self.tmpdir, 'prefetch.xml')
+		with open(feed, 'w') as stream:
+			stream.write("""<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface" xmlns:compile="http://zero-install.sourceforge.net/2006/namespaces/0compile">
+  <name>prefetch</name>
+  <summary>source which must be downloaded</summary>
+  <feed-for interface='http://example.com/prefetch.xml'/>
+  <implementation arch='*-src' id='%s' version='0.1'>
+    <manifest-digest %s='%s'/>
+    <archive href='http://127.0.0.1:%d/prefetch-0.1.tar.gz' size='%d' extract='prefetch-0.1'/>
+    <command name='compile' shell-command='cp "$SRCDIR/README" "$DISTDIR/"'>
+      <compile:implementation main='README'/>
+    </command>
+  </implementation>
+</interface>
+""" % (digest, alg, value, server.server_port, os.path.getsize(archive)))
+
+		config_dir = basedir.save_config_path('0install.net', 'injector')
+		with open(os.path.join(config_dir, 'global'), 'w') as stream:
+			stream.write('[global]\n'
+					'freshness = -1\n'
+					'help_with_testing = True\n'
+					'network_use = full\n')
+		os.environ['no_proxy'] = '127.0.0.1'
+		trace_file = os.path.join(self.tmpdir, 'trace.json')
+		try:
+			compile('autocompile', '--trace', trace_file, feed, expect = "No dependencies need compiling... compile prefetch itself...")
+		finally:
+			del os.environ['no_proxy']
+			server.shutdown()
+			thread.join()
+			server.server_close()
+
+		self.assertEqual(['/prefetch-0.1.tar.gz'], requests)
+		with open(trace_file) as stream:
+			events = json.load(stream)['traceEvents']
+		# The source was downloaded by prefetch, not when the build started
+		lanes = [event['args']['name'] for event in events if event['name'] == 'thread_name']
+		assert 'download 1' in lanes, lanes
+
+	def testPlanOnly(self):
+		import json
+		top = os.path.join(mydir, 'top.xml')
+		def get_plan():
+			return json.loads(subprocess.check_output([sys.executable, compile_bin, 'autocompile', '--plan-only', '--json', top]).decode('utf-8'))
+		plan = get_plan()
+		self.assertEqual(['cprog', 'top.xml'], [os.path.basename(b['interface']).split('-')[0] for b in plan['builds']])
+		self.assertEqual([None, None], [b['estimate'] for b in plan['builds']])
+
+		compile('autocompile', top, expect = "Estimated time: unknown")
+
+		# The cprog build is used now, but we know how long top takes to build
+		plan = get_plan()
+		build, = plan['builds']
+		assert build['estimate'] > 0, build
+		compile('autocompile', '--json', top, expect = "--json can only be used with --plan-only", expect_status = 1)
+
+	def testAutocompileTrace(self):
+		import json
+		top = os.path.join(mydir, 'top.xml')
+		trace_file = os.path.join(self.tmpdir, 'trace.json')
+		compile('autocompile', '--trace', trace_file, top, expect = "No dependencies need compiling... compile cprog itself...")
+		with open(trace_file) as stream:
+			events = json.load(stream)['traceEvents']
+		spans = [event['name'] for event in events if event['ph'] == 'X']
+		for name in ['plan', 'solve', 'download', 'spawn_build', 'copy into site-packages', 'register feed']:
+			assert name in spans, spans
+		lanes = [event['args']['name'] for event in events if event['name'] == 'thread_name']
+		self.assertEqual(['plan', 'build 1'], lanes)
+
+	def testKeepGoing(self):
+		top = os.path.join(mydir, 'keep-going', 'top.xml')
+		compile('autocompile', top, expect = "Build failed", expect_status = 1)
+		compile('autocompile', '--keep-going', top, expect = "Skipping %s 0.1, because %s 0.1 failed" % (
+			top, os.path.join(mydir, 'keep-going', 'broken.xml')), expect_status = 1)
+
+		# The build which didn't need the broken one was still done
+		run(zi_command, "run", local_cprog_command_path, expect = 'Hello from C')
+
+	def testParallel(self):
+		top = os.path.join(mydir, 'keep-going', 'top.xml')
+		# (the builds' output is prefixed with their names)
+		compile('autocompile', '--parallel', '2', top, expect = "[broken] Build failed with exit code 1", expect_status = 1)
+		compile('autocompile', '--parallel', '2', '--keep-going', top, expect = "Failed to build %s 0.1" % (
+			os.path.join(mydir, 'keep-going', 'broken.xml')), expect_status = 1)
+		run(zi_command, "run", local_cprog_command_path, expect = 'Hello from C')
+
+	def testResume(self):
+		top = os.path.join(mydir, 'keep-going', 'top.xml')
+		compile('autocompile', '--resume', top, expect = "No interrupted run", expect_status = 1)
+		# (cprog was built before the broken build failed)
+		compile('autocompile', '--resume', '--keep-going', top, expect = "Resuming the interrupted run: 1 of 3 builds already done", expect_status = 1)
+
 	def testLocal(self):
 		compile('setup', local_hello_path, self.hello_dir, expect = 'Created directory')
 		os.chdir(self.hello_dir)
@@ -150,6 +293,13 @@ class TestCompile(unittest.TestCase):
 
 		run(zi_command, "run", os.path.join(target_dir, '0install', 'feed.xml'), expect = 'ROX-Lib')
 	
+	def testSelectionsCache(self):
+		compile('setup', local_hello_path, self.hello_dir, expect = 'Created directory')
+		os.chdir(self.hello_dir)
+		compile('build', expect = 'Executing: ls -l')
+		assert os.path.exists(support.SELECTIONS_CACHE)
+		compile('-v', 'clean', expect = 'Using selections from')
+
 	def testBadVersion(self):
 		compile('setup', local_bad_version, self.hello_dir, expect = 'Created directory')
 		os.chdir(self.hello_dir)
@@ -169,6 +319,228 @@ class TestCompile(unittest.TestCase):
 		assert impl.arch, "Missing arch on %s" % impl
 		self.assertEqual("Public Domain", str(impl.metadata['license']))
 
+		# Resource usage of the build was recorded
+		from xml.dom import minidom
+		build_env = minidom.parse(os.path.join(target_dir, '0install', 'build-environment.xml'))
+		build_info, = build_env.getElementsByTagNameNS(support.XMLNS_0COMPILE, 'build-info')
+		assert float(build_info.getAttribute('user-time')) >= 0
+		assert int(build_info.getAttribute('max-rss-kb')) > 0
+
+	def testCompressedLog(self):
+		comp_dir = os.path.join(self.tmpdir, 'cprog-command')
+		compile('setup', local_cprog_command_path, comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', '--log-compression=gzip', expect = 'Hello from C!')
+		assert not os.path.exists(os.path.join('build', 'build-success.log'))
+		import gzip
+		with gzip.open(os.path.join('build', 'build-success.log.gz'), 'rt') as stream:
+			log = stream.read()
+		assert 'Hello from C!' in log, log
+		assert 'Build successful' in log, log
+
+	def testSplitUTF8(self):
+		# The build writes a two-byte character one byte at a time, so we read it in two parts
+		comp_dir = os.path.join(self.tmpdir, 'split-utf8')
+		compile('setup', os.path.join(mydir, 'split-utf8', 'split-utf8.xml'), comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', expect = None)
+		with open(os.path.join('build', 'build-success.log'), encoding = 'utf-8') as stream:
+			log = stream.read()
+		assert u'Caf\xe9!' in log, log
+
+	def testJobs(self):
+		comp_dir = os.path.join(self.tmpdir, 'cprog-command')
+		compile('setup', local_cprog_command_path, comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', '--jobs=0', expect = '--jobs must be', expect_status = 1)
+		compile('build', '--jobs=2', expect = 'MAKEFLAGS=-j2')
+		compile('build', '--force', '--jobs=auto', expect = 'MAKEFLAGS=-j')
+
+		# (make uses the last -j, so ours must go after any inherited one)
+		os.environ['MAKEFLAGS'] = '-j8'
+		try:
+			compile('build', '--force', '--jobs=2', expect = 'MAKEFLAGS=-j8 -j2')
+		finally:
+			del os.environ['MAKEFLAGS']
+
+	def testCompilerCache(self):
+		comp_dir = os.path.join(self.tmpdir, 'cprog-command')
+		compile('setup', local_cprog_command_path, comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', '--compiler-cache', expect = 'Hello from C!')
+		compile('cache', 'stats', expect = 'Uncacheable:   1')
+		compile('cache', 'clear', expect = 'Cleared')
+		compile('cache', 'stats', expect = 'Hits:          0')
+		compile('cache', 'foo', expect = 'usage', expect_status = 1)
+
+	def testCompilerCacheHit(self):
+		import json
+		work_dir = os.path.join(self.tmpdir, 'work')
+		os.mkdir(work_dir)
+		with open(os.path.join(work_dir, 'warn.c'), 'w') as stream:
+			stream.write('int main(void) { int unused; return 0; }\n')
+		cache_dir = os.path.join(self.tmpdir, 'compiler-cache')
+		env = dict(os.environ, ZI_COMPILE_CACHE_DIR = cache_dir)
+		wrapper = os.path.join(os.path.dirname(mydir), 'compiler_cache.py')
+		for expected in [{'hits': 0, 'misses': 1}, {'hits': 1, 'misses': 1}]:
+			if os.path.exists(os.path.join(work_dir, 'warn.o')):
+				os.unlink(os.path.join(work_dir, 'warn.o'))
+			child = subprocess.Popen([sys.executable, wrapper, 'cc', '-Wall', '-c', 'warn.c', '-o', 'warn.o'],
+					cwd = work_dir, env = env, stderr = subprocess.PIPE)
+			unused, stderr = child.communicate()
+			self.assertEqual(0, child.returncode)
+			assert os.path.exists(os.path.join(work_dir, 'warn.o'))
+			# (the warning is shown again for a hit)
+			assert b'unused' in stderr, stderr
+			with open(os.path.join(cache_dir, 'stats.json')) as stream:
+				stats = json.load(stream)
+			self.assertEqual(expected, {'hits': stats['hits'], 'misses': stats['misses']})
+
+	def testPkgConfigOverrideCache(self):
+		# A stored library whose .pc file has an absolute prefix
+		lib_dir = os.path.join(self.tmpdir, 'pcdep-1')
+		os.makedirs(os.path.join(lib_dir, 'lib', 'pkgconfig'))
+		with open(os.path.join(lib_dir, 'lib', 'pkgconfig', 'pcdep.pc'), 'w') as stream:
+			stream.write('prefix=/usr\nlibdir=${prefix}/lib\n\nName: pcdep\nDescription: testing\nVersion: 1\n')
+		digest = subprocess.check_output(zi_command + ['digest', lib_dir]).decode('utf-8').strip()
+		alg, value = digest.split('=' if '=' in digest else '_', 1)
+		run(zi_command, 'store', 'add', digest, lib_dir, expect = None)
+
+		with open(os.path.join(self.tmpdir, 'pcdep.xml'), 'w') as stream:
+			stream.write("""<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>pcdep</name>
+  <summary>library with an absolute prefix in its .pc file</summary>
+  <implementation id='%s' version='1'>
+    <manifest-digest %s='%s'/>
+  </implementation>
+</interface>
+""" % (digest, alg, value))
+		src_dir = os.path.join(self.tmpdir, 'pcuser')
+		os.mkdir(src_dir)
+		with open(os.path.join(src_dir, 'pcuser.xml'), 'w') as stream:
+			stream.write("""<?xml version="1.0" ?>
+<interface xmlns="http://zero-install.sourceforge.net/2004/injector/interface">
+  <name>pcuser</name>
+  <summary>builds against pcdep</summary>
+  <implementation arch='*-src' id='.' version='0.1'>
+    <command name='compile' shell-command='cat "$TMPDIR/pkg-config-overrides/pcdep.pc"'>
+      <requires interface='../pcdep.xml'>
+        <environment name='PKG_CONFIG_PATH' insert='lib/pkgconfig'/>
+      </requires>
+    </command>
+  </implementation>
+</interface>
+""")
+
+		comp_dir = os.path.join(self.tmpdir, 'pcuser-build')
+		compile('setup', os.path.join(src_dir, 'pcuser.xml'), comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', expect = 'pkg-config override cache: 0 hits, 1 misses')
+		# The second build links to the copy rewritten by the first
+		compile('build', '--force', expect = 'pkg-config override cache: 1 hits, 0 misses')
+		compile('build', '--force', expect = '/%s/usr' % digest)
+		cache_dir = os.path.join(basedir.save_cache_path('0install.net', '0compile'), 'pkg-config-overrides')
+		self.assertEqual(1, len(os.listdir(cache_dir)))
+
+	def testLibraryIndex(self):
+		build = import_command_module('build')
+		libdir = os.path.join(self.tmpdir, 'lib')
+		other_libdir = os.path.join(self.tmpdir, 'lib2')
+		os.mkdir(libdir)
+		os.mkdir(other_libdir)
+		def add_lib(d, name):
+			with open(os.path.join(d, name), 'w'):
+				pass
+			os.utime(d, ns = (0, os.stat(d).st_mtime_ns + 10 ** 9))	# (make sure the mtime changes)
+			return os.path.join(d, name)
+
+		foo = add_lib(libdir, 'libfoo.so.1')
+		index = build.LibraryIndex([libdir, other_libdir])
+		self.assertEqual(foo, index.find('libfoo.so.1'))
+		self.assertEqual(None, index.find('libbar.so.2'))
+		index.save()
+
+		# A new file changes the directory's mtime, so its cached listing isn't used
+		bar = add_lib(libdir, 'libbar.so.2')
+		index = build.LibraryIndex([libdir, other_libdir])
+		assert index.changed
+		self.assertEqual(bar, index.find('libbar.so.2'))
+		index.save()
+
+		# An indexed file which is now a broken symlink is skipped
+		baz = add_lib(other_libdir, 'libbaz.so.3')
+		os.symlink('missing', os.path.join(libdir, 'libbaz.so.3'))
+		index = build.LibraryIndex([libdir, other_libdir])
+		self.assertEqual(os.path.join(libdir, 'libbaz.so.3'), index.index['libbaz.so.3'])
+		self.assertEqual(baz, index.find('libbaz.so.3'))
+
+		# A changed ld.so.conf (or included file) means parsing it again
+		index.cache['ldconf']['deps']['/etc/ld.so.conf'] = -1
+		index.cache['ldconf']['libdirs'] = ['/stale']
+		self.assertNotEqual(['/stale'], index.get_ldconf_libdirs())
+
+	def testBrokenSymlinksCache(self):
+		import types
+		build = import_command_module('build')
+		ext = '.dylib' if sys.platform == 'darwin' else '.so'
+		def make_impl(name, local):
+			path = os.path.join(self.tmpdir, name)
+			os.makedirs(os.path.join(path, 'lib'))
+			os.symlink('libfoo%s.1' % ext, os.path.join(path, 'lib', 'libfoo' + ext))
+			return types.SimpleNamespace(id = name, path = path, local_path = path if local else None)
+		stored = make_impl('sha256new_TESTDIGEST', local = False)
+		local = make_impl('local', local = True)
+
+		real_lookup = build.lookup
+		build.lookup = lambda impl: impl.path
+		try:
+			expected = {'foo': 'libfoo%s.1' % ext}
+			self.assertEqual({stored.id: expected, local.id: expected},
+					build.find_all_broken_version_symlinks([stored, local]))
+
+			# Only the local implementation is scanned again
+			for impl in [stored, local]:
+				os.symlink('libbar%s.2' % ext, os.path.join(impl.path, 'lib', 'libbar' + ext))
+			results = build.find_all_broken_version_symlinks([stored, local])
+			self.assertEqual(expected, results[stored.id])
+			self.assertEqual(dict(expected, bar = 'libbar%s.2' % ext), results[local.id])
+		finally:
+			build.lookup = real_lookup
+
+	def testRamBuild(self):
+		comp_dir = os.path.join(self.tmpdir, 'cprog-command')
+		compile('setup', local_cprog_command_path, comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', '--ram-build', expect = 'Hello from C!')
+		target_dir = 'cprog-command-%s' % support.get_arch_name().lower()
+		assert os.path.exists(os.path.join(target_dir, '0install', 'feed.xml'))
+		assert os.path.exists(os.path.join('build', 'build-success.log'))
+		assert not os.path.exists('.new-' + target_dir)
+
+		# (unless there was no room for it in memory)
+		ram_build_root = support.get_ram_build_root()
+		if os.path.isdir(ram_build_root):
+			compile('clean', expect = "Removing '%s'" % ram_build_root)
+			assert not os.path.exists(ram_build_root)
+
+	def testTrace(self):
+		comp_dir = os.path.join(self.tmpdir, 'cprog-command')
+		compile('setup', local_cprog_command_path, comp_dir, expect = 'Created directory')
+		os.chdir(comp_dir)
+		compile('build', '--trace', expect = 'Hello from C!')
+		env = support.BuildEnv()
+		import json
+		with open(os.path.join(env.metadir, 'build-trace.json')) as stream:
+			spans = json.load(stream)['spans']
+		phases = [span['name'] for span in spans if span['kind'] == 'phase']
+		for phase in ['startup', 'solve', 'load-selections', 'prepare-env', 'build-command', 'post-build-fixups']:
+			assert phase in phases, phases
+		assert any(span['kind'] == 'subprocess' for span in spans), spans
+		# Only the parent process solves
+		solves = [span for span in spans if span['kind'] == 'subprocess' and 'download' in span['args']]
+		self.assertEqual(1, len(solves))
+
 	def testCopySrc(self):
 		comp_dir = os.path.join(self.tmpdir, 'cprog')
 		compile('setup', local_cprog_path, comp_dir, expect = 'Created directory')
@@ -192,13 +564,33 @@ class TestCompile(unittest.TestCase):
 		prog = prog.replace('Hello', 'Goodbye')
 		with open(os.path.join('src','main.c'), 'w') as stream:
 			stream.write(prog)
+		# (diff quotes names with spaces)
+		with open(os.path.join('src', 'new file.txt'), 'w') as stream:
+			stream.write('Added\n')
 		compile('diff', expect = 'diff')
 		shutil.rmtree('build')
 		compile('build', expect = 'Goodbye from C')
-		assert os.path.exists(patch_file)
+		with open(patch_file) as stream:
+			patch = stream.read()
+		assert 'Goodbye' in patch, patch
+		assert '+Added' in patch, patch
+
+		# Nothing has changed, so there's no need to build again
+		compile('build', expect = 'Nothing to do')
+
+		# ... but changing the build options does need one
+		compile('build', '--log-compression=gzip', expect = 'Goodbye from C')
+		compile('build', '--log-compression=gzip', expect = 'Nothing to do')
 
 		# Test dup-src's unlinking while we're here
-		compile('build', expect = 'Goodbye from C')
+		compile('build', '--force', expect = 'Goodbye from C')
+
+		# diff fails on a dangling symlink (e.g. an Emacs lock file), but the build still works
+		os.symlink('nowhere', os.path.join('src', '.#main.c'))
+		compile('build', '--force', expect = 'Goodbye from C')
+		with open(patch_file) as stream:
+			assert 'Goodbye' in stream.read()
+		os.unlink(os.path.join('src', '.#main.c'))
 
 		# 'src' contains an error
 		with open(os.path.join('src','main.c'), 'w') as stream: